@@ -1,21 +1,42 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import requests
 import geopandas as gpd
+import pandas as pd
 import leafmap.foliumap as leafmap
 import json
-from io import StringIO
+import base64
+import re
+from datetime import date
+from io import BytesIO, StringIO
+from PIL import Image
 import folium
+from branca.element import MacroElement
+from jinja2 import Template
 
 # --- Configuration ---
 API_BASE_URL = "https://latdn3bjub.execute-api.eu-north-1.amazonaws.com/default"
 RASTER_EXTENSIONS = (".tif", ".png")
 VECTOR_EXTENSIONS = (".geojson", ".gpkg", ".shp")
+MAP_HEIGHT = 500
+DEFAULT_OPACITY = 1.0
+# Attribute columns checked (in order) for per-class feature counts
+CLASS_FIELDS = ("macroclass_id", "class_id", "MC_ID", "C_ID")
+ROWS_PER_PAGE = 100
+THUMBNAIL_SIZE = (320, 320)
+RUNS_PER_PAGE = 15
+FILE_TREE_TTL = 60  # seconds before the bucket listing is fetched again
+# Run folders are named like "RandomForest-20251006T1106..."
+RUN_DATE_PATTERN = re.compile(r"(\d{4})-?(\d{2})-?(\d{2})")
 
 
 # --- Session State Initialization ---
 # We use session_state to keep track of layers the user has "loaded"
 if "layers" not in st.session_state:
     st.session_state["layers"] = []
+# Each layer gets a stable id so the rendered map can be cached per layer set
+if "next_layer_id" not in st.session_state:
+    st.session_state["next_layer_id"] = 0
 
 # --- Sidebar: File Selection ---
 st.sidebar.title("Geospatial Data Visualiser", text_alignment="center")
@@ -23,6 +44,54 @@ st.sidebar.divider()
 st.sidebar.header("AWS File Explorer")
 
 
+def png_to_data_uri(image_bytes):
+    """Encode PNG bytes as a data URI so overlays render without a second download"""
+    encoded = base64.b64encode(image_bytes).decode("utf-8")
+    return f"data:image/png;base64,{encoded}"
+
+
+def new_layer_id():
+    """Return a unique id for a newly loaded layer"""
+    layer_id = st.session_state["next_layer_id"]
+    st.session_state["next_layer_id"] += 1
+    return layer_id
+
+
+def summarise_vector(gdf):
+    """
+    Build the attribute table and summary shown in the details panel.
+    Runs once when the layer is loaded so reruns only slice cached results.
+    """
+    attributes = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    attributes["geometry_type"] = gdf.geom_type.to_numpy()
+
+    class_field = next((c for c in CLASS_FIELDS if c in gdf.columns), None)
+    class_counts = None
+    if class_field:
+        class_counts = (
+            gdf[class_field].value_counts().sort_index().rename("features").to_frame()
+        )
+
+    min_lon, min_lat, max_lon, max_lat = gdf.total_bounds
+    summary = {
+        "feature_count": len(gdf),
+        "class_field": class_field,
+        "class_counts": class_counts,
+        "extent": [round(float(v), 6) for v in (min_lon, min_lat, max_lon, max_lat)],
+    }
+    return attributes, summary
+
+
+def make_thumbnail(image_bytes):
+    """Downscale a PNG so the details panel never re-sends the full raster"""
+    with Image.open(BytesIO(image_bytes)) as img:
+        size = img.size
+        img.thumbnail(THUMBNAIL_SIZE)
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+    return buffer.getvalue(), size
+
+
 def add_to_map(run_id, filename):
     """Fetch data and add it to the session state layer list"""
     full_url = f"{API_BASE_URL}/api/get-data/{run_id}/{filename}"
@@ -42,10 +111,22 @@ def add_to_map(run_id, filename):
                     geojson_str = json.dumps(geo_data_dict)
                     gdf = gpd.read_file(StringIO(geojson_str))
                     gdf = gdf.to_crs(epsg=4326)
+                    attributes, summary = summarise_vector(gdf)
+                    min_lon, min_lat, max_lon, max_lat = gdf.total_bounds
 
-                    # Store in session state
+                    # Serialize once here; the map embeds this string on
+                    # every rebuild instead of converting the GeoDataFrame again.
+                    # "<\/" keeps attribute values from closing the script tag
                     st.session_state["layers"].append(
-                        {"type": "vector", "name": f"{run_id}/{filename}", "data": gdf}
+                        {
+                            "id": new_layer_id(),
+                            "type": "vector",
+                            "name": f"{run_id}/{filename}",
+                            "geojson": gdf.to_json().replace("</", "<\\/"),
+                            "bounds": [[min_lat, min_lon], [max_lat, max_lon]],
+                            "attributes": attributes,
+                            "summary": summary,
+                        }
                     )
                     st.sidebar.success(f"Added {filename}")
                 except Exception as e:
@@ -63,14 +144,24 @@ def add_to_map(run_id, filename):
                     )  # [min_lon, min_lat, max_lon, max_lat]
                     # Leaflet needs [[min_lat, min_lon], [max_lat, max_lon]]
                     leaf_bounds = [[bounds[1], bounds[0]], [bounds[3], bounds[2]]]
+                    thumbnail, (width, height) = make_thumbnail(image)
 
+                    # Encode once here; the overlay is embedded from this on
+                    # every rerun instead of the browser refetching full_url
                     st.session_state["layers"].append(
                         {
+                            "id": new_layer_id(),
                             "type": "raster",
                             "name": f"{run_id}/{filename}",
-                            "url": full_url,
                             "bounds": leaf_bounds,
-                            "image_data": image,
+                            "data_uri": png_to_data_uri(image),
+                            "thumbnail": thumbnail,
+                            "summary": {
+                                "width": width,
+                                "height": height,
+                                "size_kb": round(len(image) / 1024, 1),
+                                "extent": [round(float(v), 6) for v in bounds],
+                            },
                         }
                     )
 
@@ -82,33 +173,126 @@ def add_to_map(run_id, filename):
 
 
 # 1. Fetch the file structure for the sidebar
-try:
+def parse_run_id(run_id):
+    """Split a run folder name into its algorithm and date (either may be None)"""
+    algorithm = re.split(r"[-_]", run_id, maxsplit=1)[0] or None
+
+    run_date = None
+    match = RUN_DATE_PATTERN.search(run_id)
+    if match:
+        try:
+            run_date = date(*(int(g) for g in match.groups()))
+        except ValueError:
+            pass
+
+    return algorithm, run_date
+
+
+@st.cache_data(ttl=FILE_TREE_TTL, show_spinner=False)
+def fetch_run_index():
+    """
+    Fetch the bucket listing and index it by run. Cached so reruns do not
+    hit the API, and so filtering never walks the raw listing again.
+    """
     fs_response = requests.get(f"{API_BASE_URL}/api/get-file-structure/data_storage")
-    if fs_response.status_code == 200:
-        file_tree = fs_response.json()
-
-        for run_id, files in file_tree.items():
-            with st.sidebar.expander(f"📁 Run: {run_id}"):
-                for f in files:
-                    col1, col2 = st.columns([3, 1])
-                    col1.text(f)
-                    # Logic: Only show the "+" button if it's a map-compatible file
-                    is_vector = f.lower().endswith(VECTOR_EXTENSIONS)
-                    is_raster = f.lower().endswith(RASTER_EXTENSIONS)
-
-                    if is_vector or is_raster:
-                        if col2.button("➕", key=f"add_{run_id}_{f}"):
-                            add_to_map(run_id, f)
-                    else:
-                        col2.write("")
-    else:
-        st.sidebar.error("Failed to load file structure.")
-except Exception as e:
-    st.sidebar.error(f"Connection error: {e}")
+    fs_response.raise_for_status()
+
+    runs = []
+    for run_id, files in fs_response.json().items():
+        algorithm, run_date = parse_run_id(run_id)
+        runs.append(
+            {"run_id": run_id, "algorithm": algorithm, "date": run_date, "files": files}
+        )
+
+    # Newest runs first; runs without a parsable date go last
+    runs.sort(key=lambda r: (r["date"] or date.min, r["run_id"]), reverse=True)
+    return runs
+
+
+def filter_runs(runs, search, algorithms, date_range):
+    """Apply the run browser filters"""
+    search = search.strip().lower()
+    filtered = []
+    for run in runs:
+        if search and search not in run["run_id"].lower():
+            continue
+        if algorithms and run["algorithm"] not in algorithms:
+            continue
+        if len(date_range) == 2:
+            if run["date"] is None or not date_range[0] <= run["date"] <= date_range[1]:
+                continue
+        filtered.append(run)
+    return filtered
+
+
+def render_run_files(run):
+    """List one run's files with an add button for map-compatible ones"""
+    run_id = run["run_id"]
+    for f in run["files"]:
+        col1, col2 = st.columns([3, 1])
+        col1.text(f)
+        # Logic: Only show the "+" button if it's a map-compatible file
+        is_vector = f.lower().endswith(VECTOR_EXTENSIONS)
+        is_raster = f.lower().endswith(RASTER_EXTENSIONS)
+
+        if is_vector or is_raster:
+            if col2.button("➕", key=f"add_{run_id}_{f}"):
+                layer_count = len(st.session_state["layers"])
+                add_to_map(run_id, f)
+                # The map lives outside this fragment, so redraw the whole app
+                if len(st.session_state["layers"]) > layer_count:
+                    st.rerun(scope="app")
+        else:
+            col2.write("")
+
+
+@st.fragment
+def render_run_browser():
+    """
+    Sidebar run browser. Only one page of run names and the files of the
+    selected run are rendered, so its cost does not grow with the bucket.
+    """
+    try:
+        runs = fetch_run_index()
+    except Exception as e:
+        st.error(f"Failed to load file structure: {e}")
+        return
+
+    if st.button("🔄 Refresh Runs"):
+        fetch_run_index.clear()
+        runs = fetch_run_index()
+
+    search = st.text_input("Search Run ID", placeholder="e.g. RandomForest")
+    algorithm_options = sorted({r["algorithm"] for r in runs if r["algorithm"]})
+    algorithms = st.multiselect("Algorithm", algorithm_options)
+    date_range = st.date_input("Run Date Range", value=[])
+
+    filtered = filter_runs(runs, search, algorithms, date_range)
+    if not filtered:
+        st.info("No runs match the filters.")
+        return
+
+    page_count = -(-len(filtered) // RUNS_PER_PAGE)
+    page = 1
+    if page_count > 1:
+        page = st.number_input(
+            f"Page (of {page_count})", min_value=1, max_value=page_count, value=1
+        )
+    start = (page - 1) * RUNS_PER_PAGE
+    page_runs = filtered[start : start + RUNS_PER_PAGE]
+
+    st.caption(f"{len(filtered)} of {len(runs)} runs")
+    # Options are run ids, not positions, so a page or filter change can
+    # never leave a different run selected under the same index
+    runs_by_id = {r["run_id"]: r for r in page_runs}
+    selected = st.radio("📁 Runs", options=list(runs_by_id), index=None)
+    if selected is not None:
+        render_run_files(runs_by_id[selected])
 
 
-# Sidebar for opacity control
-global_opacity = st.sidebar.slider("Layer Opacity", 0.0, 1.0, 1.0, 0.05)
+with st.sidebar:
+    render_run_browser()
+
 
 st.sidebar.divider()
 
@@ -117,47 +301,227 @@ if st.sidebar.button("🗑️ Clear All Layers"):
     st.session_state["layers"] = []
     st.rerun()
 
+
 # --- Map Rendering ---
-# Create the base map
-m = leafmap.Map(draw_control=False, measure_control=False, fullscreen_control=True)
-m.add_basemap("HYBRID", show=False)  # Add a high-res basemap
-
-# Add the layers from session state
-for layer in st.session_state["layers"]:
-    if layer["type"] == "vector":
-        m.add_gdf(
-            layer["data"],
-            layer_name=layer["name"],
-            zoom_to_layer=True,
-            info_mode="on_click",
-            opacity=global_opacity,
-        )
-    elif layer["type"] == "raster":
-        # Using the direct Folium ImageOverlay for better stability with PNGs
-        m.fit_bounds(layer["bounds"])
-        img_overlay = folium.raster_layers.ImageOverlay(
-            name=layer["name"],
-            image=layer["url"],
-            bounds=layer["bounds"],
-            opacity=global_opacity,
-            interactive=True,
-            cross_origin=False,
-            zindex=1,
-        )
-        img_overlay.add_to(m)
+class OpacityControl(MacroElement):
+    """
+    Leaflet slider that restyles every overlay in the browser.
+    Opacity changes never reach Streamlit, so moving the slider
+    does not rerun the script or re-send any layer data. The last
+    value is kept in localStorage, so a rebuilt map starts from it.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+        (function () {
+            var map = {{ this._parent.get_name() }};
+            var storageKey = "qgis-ml-layer-opacity";
+            var opacity = {{ this.opacity }};
+            try {
+                var stored = parseFloat(window.localStorage.getItem(storageKey));
+                if (!isNaN(stored)) {
+                    opacity = stored;
+                }
+            } catch (e) {
+                // Storage is blocked in this frame; start from the default
+            }
+
+            function applyOpacity(layer) {
+                if (layer instanceof L.ImageOverlay || layer instanceof L.Marker) {
+                    layer.setOpacity(opacity);
+                } else if (layer instanceof L.Path) {
+                    // Fills are drawn at half the stroke opacity, as in CachedGeoJson
+                    layer.setStyle({opacity: opacity, fillOpacity: opacity * 0.5});
+                }
+            }
+
+            var control = L.control({position: "topright"});
+            control.onAdd = function () {
+                var div = L.DomUtil.create("div", "leaflet-bar");
+                div.style.background = "white";
+                div.style.padding = "4px 8px";
+                div.innerHTML = '<label>Layer Opacity <input type="range" ' +
+                    'min="0" max="1" step="0.05" value="' + opacity + '"></label>';
+                L.DomEvent.disableClickPropagation(div);
+                L.DomEvent.disableScrollPropagation(div);
+                div.querySelector("input").addEventListener("input", function (e) {
+                    opacity = parseFloat(e.target.value);
+                    map.eachLayer(applyOpacity);
+                    try {
+                        window.localStorage.setItem(storageKey, String(opacity));
+                    } catch (err) {
+                        // Not persisted; the slider still works for this map
+                    }
+                });
+                return div;
+            };
+            control.addTo(map);
+            map.eachLayer(applyOpacity);
+
+            // Layers toggled back on in the layer control pick up the current value
+            map.on("overlayadd", function (e) {
+                if (e.layer.eachLayer) {
+                    e.layer.eachLayer(applyOpacity);
+                }
+                applyOpacity(e.layer);
+            });
+        })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, opacity=DEFAULT_OPACITY):
+        super().__init__()
+        self._name = "OpacityControl"
+        self.opacity = opacity
+
+
+class CachedGeoJson(folium.map.Layer):
+    """
+    GeoJSON overlay built from an already serialized string. The string is
+    written into the page as is, so rebuilding the map never re-serializes
+    a layer. Clicking a feature shows its attributes.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = L.geoJson({{ this.geojson }}, {
+            style: function () {
+                return {opacity: {{ this.opacity }}, fillOpacity: {{ this.opacity }} * 0.5};
+            },
+            onEachFeature: function (feature, layer) {
+                var props = feature.properties || {};
+                var rows = Object.keys(props).map(function (key) {
+                    var cell = document.createElement("td");
+                    cell.textContent = props[key];
+                    var header = document.createElement("th");
+                    header.textContent = key;
+                    return "<tr>" + header.outerHTML + cell.outerHTML + "</tr>";
+                });
+                if (rows.length) {
+                    layer.bindPopup("<table>" + rows.join("") + "</table>");
+                }
+            }
+        });
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, geojson, name, opacity=DEFAULT_OPACITY):
+        super().__init__(name=name, overlay=True)
+        self._name = "CachedGeoJson"
+        self.geojson = geojson
+        self.opacity = opacity
+
+
+def build_map_html(layers):
+    """Build the folium map for the given layers and serialize it to HTML"""
+    # Create the base map
+    m = leafmap.Map(draw_control=False, measure_control=False, fullscreen_control=True)
+    m.add_basemap("HYBRID", show=False)  # Add a high-res basemap
+
+    # Add the layers from session state
+    for layer in layers:
+        if layer["type"] == "vector":
+            # Embeds the GeoJSON string serialized in add_to_map
+            m.fit_bounds(layer["bounds"])
+            CachedGeoJson(layer["geojson"], layer["name"]).add_to(m)
+        elif layer["type"] == "raster":
+            # Using the direct Folium ImageOverlay for better stability with PNGs.
+            # The image is inlined from the bytes already fetched in add_to_map,
+            # so the browser never downloads it from the API again.
+            m.fit_bounds(layer["bounds"])
+            img_overlay = folium.raster_layers.ImageOverlay(
+                name=layer["name"],
+                image=layer["data_uri"],
+                bounds=layer["bounds"],
+                opacity=DEFAULT_OPACITY,
+                interactive=True,
+                cross_origin=False,
+                zindex=1,
+            )
+            img_overlay.add_to(m)
+
+    # Add the Layer Control (the toggle UI) and the client-side opacity slider
+    m.add_layer_control()
+    OpacityControl().add_to(m)
+
+    return m.to_html()
+
+
+@st.fragment
+def render_map():
+    """
+    Render the map in its own fragment. The HTML is only rebuilt when the
+    set of loaded layers changes; otherwise the cached copy is reused and
+    Streamlit leaves the existing iframe untouched. A rebuild only stitches
+    together the strings each layer was serialized to when it was loaded.
+    """
+    layers = st.session_state["layers"]
+    layers_key = tuple(layer["id"] for layer in layers)
+
+    cached = st.session_state.get("map_html")
+    if cached is None or cached["key"] != layers_key:
+        cached = {"key": layers_key, "html": build_map_html(layers)}
+        st.session_state["map_html"] = cached
+
+    components.html(cached["html"], height=MAP_HEIGHT)
 
-# Add the Layer Control (the toggle UI)
-m.add_layer_control()
 
 # Display the map in the main area
-m.to_streamlit(height=500)
+render_map()
+
 
 # --- Metadata/Details Section ---
-if st.session_state["layers"]:
+def render_attribute_page(layer):
+    """Show one page of a vector layer's attribute table (geometry excluded)"""
+    attributes = layer["attributes"]
+    page_count = max(1, -(-len(attributes) // ROWS_PER_PAGE))
+
+    if page_count > 1:
+        page = st.number_input(
+            f"Page (of {page_count})",
+            min_value=1,
+            max_value=page_count,
+            value=1,
+            key=f"page_{layer['id']}",
+        )
+    else:
+        page = 1
+
+    start = (page - 1) * ROWS_PER_PAGE
+    st.dataframe(attributes.iloc[start : start + ROWS_PER_PAGE])
+
+
+@st.fragment
+def render_layer_details():
+    """
+    Paging through a table only reruns this fragment. Everything shown
+    here was computed when the layer was loaded.
+    """
     with st.expander("Layer Details & Dataframes"):
         for i, layer in enumerate(st.session_state["layers"]):
             st.write(f"**Layer {i + 1}: {layer['name']}** ({layer['type']})")
+            summary = layer["summary"]
+
             if layer["type"] == "vector":
-                st.dataframe(layer["data"])
+                col1, col2 = st.columns(2)
+                col1.metric("Features", summary["feature_count"])
+                col2.metric("Class Field", summary["class_field"] or "-")
+                st.caption(f"Extent [W, S, E, N]: {summary['extent']}")
+                if summary["class_counts"] is not None:
+                    st.dataframe(summary["class_counts"])
+                render_attribute_page(layer)
+
             elif layer["type"] == "raster":
-                st.image(layer["image_data"])
+                col1, col2 = st.columns(2)
+                col1.metric("Size (px)", f"{summary['width']} x {summary['height']}")
+                col2.metric("PNG Size (KB)", summary["size_kb"])
+                st.caption(f"Extent [W, S, E, N]: {summary['extent']}")
+                st.image(layer["thumbnail"])
+
+
+if st.session_state["layers"]:
+    render_layer_details()
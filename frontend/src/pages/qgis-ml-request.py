@@ -1,3 +1,7 @@
+import json
+import time
+from collections import deque
+
 import requests
 import streamlit as st
 
@@ -5,7 +9,12 @@ st.set_page_config(layout="wide", page_title="SCP Processing Request")
 
 # --- Configuration ---
 # Default to localhost since your Flask app runs on port 5000
-DEFAULT_API_URL = "http://127.0.0.1:5000/ml-request"
+DEFAULT_API_URL = "http://127.0.0.1:5000"
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+# The server sends a heartbeat every 15s, so a longer silence means it is gone
+EVENT_READ_TIMEOUT = 60
+LOG_TAIL_LINES = 20
+BATCH_POLL_INTERVAL = 3  # seconds between sweep summary refreshes
 
 # --- Sidebar: Server Config ---
 st.sidebar.title("Make a Classification Request")
@@ -13,7 +22,7 @@ st.sidebar.divider()
 
 with st.sidebar:
     st.header("Server Config")
-    api_url = st.text_input("QGIS ML Server URL", value=DEFAULT_API_URL)
+    api_url = st.text_input("QGIS ML Server URL", value=DEFAULT_API_URL).rstrip("/")
     st.info(
         "Ensure qgis-ml-server-flask.py is running. Note that only the owner of the server has access to this command."
     )
@@ -77,6 +86,53 @@ ML_MODEL_OPTIONS = [
 ]
 
 NORM_OPTIONS = ["Z-Score", "Linear Scaling"]
+NORM_VALUES = {"None": None, "Z-Score": 0, "Linear Scaling": 1}
+
+
+def parse_list(text, cast, sep=","):
+    """Parse a separated list of values, e.g. "10, 50, 100" -> [10, 50, 100]"""
+    return [cast(item.strip()) for item in text.split(sep) if item.strip()]
+
+
+def show_preflight(report):
+    """Render the server's preflight report: problems, scene size and cost estimate"""
+    for error in report["errors"]:
+        st.error(error)
+    for warning in report["warnings"]:
+        st.warning(warning)
+    if not report["ok"] or report["scene"] is None:
+        return
+
+    scene, estimate, execution = (
+        report["scene"],
+        report["estimate"],
+        report["execution"],
+    )
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric(
+        "Scene", f"{scene['width']} x {scene['height']} px", f"{scene['bands']} bands"
+    )
+    m2.metric("Memory per Job", f"{estimate['memory_mb_per_job']:,.0f} MB")
+    runtime = estimate["runtime_seconds"]
+    m3.metric(
+        "Estimated Runtime",
+        "unknown"
+        if runtime is None
+        else f"{runtime:.0f} s"
+        if runtime < 120
+        else f"{runtime / 60:.1f} min",
+        f"from {estimate['based_on_runs']} past runs" if runtime is not None else None,
+        delta_color="off",
+    )
+    m4.metric(
+        "Execution",
+        execution["mode"].capitalize(),
+        f"{execution['tiles']} tiles of {execution['tile_size']} px"
+        if execution["mode"] == "tiled"
+        else None,
+        delta_color="off",
+    )
+
 
 st.markdown("Configure the `scp-classification.py` parameters and send to QGIS Server.")
 
@@ -154,6 +210,26 @@ with st.form("scp_request_form"):
     sig_thresh_bool = b5.checkbox(
         "Signature Threshold", value=DEFAULT_PARAMS["SIGNATURE_THRESHOLD"]
     )
+    o1, o2, o3 = st.columns(3)
+    force_rerun = o1.checkbox(
+        "Force re-run",
+        value=False,
+        help="By default an identical earlier request returns its existing result.",
+    )
+    use_model_cache = o2.checkbox(
+        "Reuse cached classifier",
+        value=True,
+        help="Skip training when a model with the same training data, algorithm "
+        "and hyperparameters was trained before.",
+    )
+    tile_size = o3.number_input(
+        "Tile Size (px, 0 = whole scene)",
+        min_value=0,
+        value=0,
+        step=512,
+        help="Classify large scenes in parallel tiles and mosaic the result. "
+        "Needs a classifier: an input .rsmo, or a cached one from an earlier run.",
+    )
 
     # --- SECTION 3: ALGORITHM SPECIFICS ---
     st.subheader("3. Algorithm Specifics")
@@ -205,10 +281,35 @@ with st.form("scp_request_form"):
             format="%.4f",
         )
 
+    # --- SECTION 4: PARAMETER SWEEP ---
+    st.subheader("4. Parameter Sweep (Optional)")
+
+    with st.expander("Sweep Grid"):
+        st.caption(
+            "Every combination is queued as its own run, using the settings above "
+            "as the base. Hyperparameters only vary for the algorithm they belong to."
+        )
+        sweep_models = st.multiselect(
+            "Algorithms",
+            options=range(len(ML_MODEL_OPTIONS)),
+            format_func=lambda x: ML_MODEL_OPTIONS[x],
+        )
+        sweep_norms = st.multiselect("Input Normalization", options=norm_ui_options)
+        sw_c1, sw_c2, sw_c3 = st.columns(3)
+        sweep_rf_trees = sw_c1.text_input("RF Number of Trees (comma sep)")
+        sweep_svm_c = sw_c2.text_input("SVM Regularization C (comma sep)")
+        sweep_svm_kernel = sw_c3.text_input("SVM Kernels (comma sep)")
+        sweep_mlp_layers = st.text_input(
+            "MLP Hidden Layers (semicolon sep, e.g. 100; 100,50)"
+        )
+
     # Submit
-    submitted = st.form_submit_button("Run Classification")
+    sub1, sub2, sub3 = st.columns(3)
+    submitted = sub1.form_submit_button("Run Classification")
+    sweep_submitted = sub2.form_submit_button("Run Sweep")
+    preflight_submitted = sub3.form_submit_button("Check Request")
 
-if submitted:
+if submitted or sweep_submitted or preflight_submitted:
     # --- 1. BUILD JSON PAYLOAD ---
 
     final_bands = [line.strip() for line in bands_input.split("\n") if line.strip()]
@@ -264,44 +365,240 @@ if submitted:
         "CLASSIFIER_INPUT_RSMO": classifier_input,
         "RASTER_OUTPUT": raster_output,
         "CLASSIFICATION_FOLDER": output_folder,
+        # Server options, not passed to the algorithm
+        "FORCE_RERUN": force_rerun,
+        "USE_MODEL_CACHE": use_model_cache,
+        "TILE_SIZE": int(tile_size),
     }
 
-    # --- 2. SEND TO SERVER ---
-    st.info(f"Sending request to {api_url}...")
-
+if sweep_submitted:
+    # --- 2a. SEND SWEEP TO SERVER ---
     try:
-        with st.spinner("Processing in QGIS... this may take a while."):
-            response = requests.post(
-                api_url, json=payload, timeout=300
-            )  # 5 minute timeout
-
-            if response.status_code == 200:
-                data = response.json()
-                st.success("Classification Successful!")
+        grid = {}
+        if sweep_models:
+            grid["ML_MODEL"] = list(sweep_models)
+        if sweep_norms:
+            grid["NORMALIZATION"] = [NORM_VALUES[n] for n in sweep_norms]
+        if sweep_rf_trees:
+            grid["RF_TREES"] = parse_list(sweep_rf_trees, int)
+        if sweep_svm_c:
+            grid["SVM_REGULARIZATION"] = parse_list(sweep_svm_c, float)
+        if sweep_svm_kernel:
+            grid["SVM_KERNEL"] = parse_list(sweep_svm_kernel, str)
+        if sweep_mlp_layers:
+            grid["MLP_LAYERS"] = parse_list(sweep_mlp_layers, str, sep=";")
+    except ValueError as e:
+        st.error(f"Invalid sweep value: {e}")
+        st.stop()
+
+    if not grid:
+        st.error("Choose at least one value to sweep over.")
+        st.stop()
+
+    st.info(f"Submitting sweep to {api_url}...")
+    try:
+        response = requests.post(
+            f"{api_url}/batches", json={"base": payload, "grid": grid}, timeout=60
+        )
+        if response.status_code == 202:
+            st.session_state["active_batch"] = response.json()["batch_id"]
+        else:
+            st.error(f"Server Error: {response.status_code}")
+            st.text(response.text)
+    except requests.exceptions.ConnectionError:
+        st.error(
+            "Could not connect to the server. Is `qgis-ml-server-flask.py` running?"
+        )
 
-                # Display Results
-                result_data = data.get("result", {})
-                st.json(result_data)
+elif preflight_submitted:
+    # --- 2b. DRY RUN ---
+    try:
+        response = requests.post(f"{api_url}/jobs/preflight", json=payload, timeout=30)
+        response.raise_for_status()
+        report = response.json()
+        if report["ok"]:
+            st.success("The request passed the preflight checks.")
+        show_preflight(report)
+    except requests.exceptions.ConnectionError:
+        st.error(
+            "Could not connect to the server. Is `qgis-ml-server-flask.py` running?"
+        )
+    except requests.exceptions.HTTPError as e:
+        st.error(f"Server Error: {e}")
 
-                # Extract Output path if available
-                if "RASTER_OUTPUT" in result_data:
-                    st.write("Check AWS File Explorer for output raster")
+elif submitted:
+    # --- 2. SEND TO SERVER ---
+    st.info(f"Submitting job to {api_url}...")
 
-            else:
-                st.error(f"Server Error: {response.status_code}")
-                try:
-                    st.json(response.json())
-                except Exception as e:
-                    st.text(response.text)
-                    print(f"error: {e}")
+    try:
+        response = requests.post(f"{api_url}/jobs", json=payload, timeout=30)
+
+        if response.status_code in (200, 202):
+            job = response.json()
+            if job.get("deduplicated") == "completed":
+                st.info("An identical request already completed. Showing its result.")
+            elif job.get("deduplicated") == "in_flight":
+                st.info("An identical request is already running. Following it.")
+            for warning in job.get("preflight", {}).get("warnings", []):
+                st.warning(warning)
+            # Remember the job so polling resumes if the page reruns
+            st.session_state["active_job"] = job["job_id"]
+        else:
+            st.error(f"Server Error: {response.status_code}")
+            try:
+                body = response.json()
+                if "preflight" in body:
+                    show_preflight(body["preflight"])
+                else:
+                    st.json(body)
+            except Exception as e:
+                st.text(response.text)
+                print(f"error: {e}")
 
     except requests.exceptions.ConnectionError:
         st.error(
             "Could not connect to the server. Is `qgis-ml-server-flask.py` running?"
         )
-    except requests.exceptions.Timeout:
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
+
+
+# --- 3. FOLLOW THE JOB ---
+def stream_job_events(job_id):
+    """Yield (event, data) pairs from the server's Server-Sent Events stream"""
+    with requests.get(
+        f"{api_url}/jobs/{job_id}/events",
+        stream=True,
+        timeout=(10, EVENT_READ_TIMEOUT),
+    ) as response:
+        response.raise_for_status()
+        event = "message"
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:") :].strip()
+            elif line.startswith("data:"):
+                yield event, json.loads(line[len("data:") :])
+            elif not line:
+                event = "message"
+
+
+def follow_job(job_id):
+    """Show live progress and the log tail until the job finishes"""
+    if st.button("🛑 Cancel Job"):
+        requests.post(f"{api_url}/jobs/{job_id}/cancel", timeout=30)
+
+    log_tail = deque(maxlen=LOG_TAIL_LINES)
+    with st.status(f"Job {job_id} submitted", expanded=True) as status_box:
+        progress_bar = st.progress(0.0)
+        log_box = st.empty()
+
+        for event, data in stream_job_events(job_id):
+            if event == "log":
+                log_tail.append(f"[{data['level']}] {data['message']}")
+                log_box.code("\n".join(log_tail), language=None)
+                continue
+
+            job = data
+            progress_bar.progress(min((job.get("progress") or 0) / 100, 1.0))
+            if job["status"] in TERMINAL_STATUSES:
+                state = "complete" if job["status"] == "succeeded" else "error"
+                status_box.update(label=f"Job {job_id} {job['status']}", state=state)
+                return job
+
+            if job["status"] == "queued":
+                label = f"Job {job_id} queued (position {job.get('queue_position')})"
+            else:
+                label = f"Job {job_id}: {job.get('step') or 'processing in QGIS...'}"
+            status_box.update(label=label)
+
+    # The stream closed without a final status, so ask for it directly
+    return requests.get(f"{api_url}/jobs/{job_id}", timeout=30).json()
+
+
+if "active_job" in st.session_state:
+    job_id = st.session_state["active_job"]
+
+    try:
+        job = follow_job(job_id)
+        if job["status"] not in TERMINAL_STATUSES:
+            raise requests.exceptions.ConnectionError("Event stream ended early")
+        del st.session_state["active_job"]
+
+        if job["status"] == "succeeded":
+            st.success("Classification Successful!")
+            st.info(job.get("message"))
+
+            # Display Results
+            result_data = job.get("result") or {}
+            st.json(result_data)
+
+            # Extract Output path if available
+            if "RASTER_OUTPUT" in result_data:
+                st.write("Check AWS File Explorer for output raster")
+        elif job["status"] == "cancelled":
+            st.warning(f"Classification cancelled: {job.get('message')}")
+        else:
+            st.error(f"Classification failed: {job.get('message')}")
+
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         st.error(
-            "The request timed out. The classification might still be running in the background."
+            "Lost connection to the server. The job is still on the server; "
+            "rerun the page to resume following it."
         )
     except Exception as e:
         st.error(f"An error occurred: {e}")
+
+
+# --- 4. FOLLOW THE SWEEP ---
+def describe_variant(variant):
+    """Readable label for a sweep variant"""
+    parts = []
+    for key, value in variant.items():
+        if key == "ML_MODEL":
+            value = ML_MODEL_OPTIONS[value]
+        parts.append(f"{key}={value}")
+    return ", ".join(parts) or "base"
+
+
+def follow_batch(batch_id):
+    """Refresh the sweep summary table until every variant has finished"""
+    if st.button("🛑 Cancel Sweep"):
+        requests.post(f"{api_url}/batches/{batch_id}/cancel", timeout=30)
+
+    st.subheader(f"Sweep {batch_id}")
+    progress_bar = st.progress(0.0)
+    table = st.empty()
+
+    while True:
+        batch = requests.get(f"{api_url}/batches/{batch_id}", timeout=30).json()
+        rows = [
+            {
+                "Variant": describe_variant(v["variant"]),
+                "Status": v["status"],
+                "Runtime (s)": v["runtime_seconds"],
+                "Overall Accuracy": v["accuracy"],
+                "Message": v["message"],
+            }
+            for v in batch["variants"]
+        ]
+        finished = sum(v["status"] in TERMINAL_STATUSES for v in batch["variants"])
+        progress_bar.progress(
+            finished / len(rows), text=f"{finished} of {len(rows)} runs finished"
+        )
+        table.dataframe(rows, width="stretch")
+
+        if batch["done"]:
+            return batch
+        time.sleep(BATCH_POLL_INTERVAL)
+
+
+if "active_batch" in st.session_state:
+    try:
+        follow_batch(st.session_state["active_batch"])
+        del st.session_state["active_batch"]
+        st.success("Sweep finished. Check AWS File Explorer for the output rasters.")
+    except requests.exceptions.ConnectionError:
+        st.error(
+            "Lost connection to the server. The sweep is still on the server; "
+            "rerun the page to resume following it."
+        )
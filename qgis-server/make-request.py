@@ -1,11 +1,282 @@
+"""
+Client for the QGIS ML server. Sends one request, or submits many jobs from a
+spec file with a concurrency limit and retries, and reports per-job latency.
+
+    python make-request.py
+    python make-request.py --param ML_MODEL=3 --param CLASSIFICATION_FOLDER=C:/out
+    python make-request.py --spec jobs.json --concurrency 8 --repeat 5 --report results.csv
+
+A JSON spec is a list of parameter objects, or {"jobs": [...]}. A CSV spec has
+one column per parameter; cells are parsed as JSON where possible (numbers,
+true/false, ["a.tif", "b.tif"]) and empty cells are left out.
+
+To load test the server on a machine without QGIS or AWS, start it with the
+stand-ins from standin.py, then submit jobs with --unique so every one is run
+in full, with no deduplication and no cached classifier:
+
+    QGIS_ML_STANDIN=1 S3_LOCAL_DIR=/tmp/s3 QGIS_ML_WORKERS=4 python qgis-ml-server-flask.py
+    python make-request.py --spec load.csv --concurrency 32 --repeat 10 --unique
+"""
+import argparse
+import csv
+import json
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from urllib3.exceptions import NewConnectionError
 
-url = "http://localhost:5000/ml-request"
+# --- 1. CONFIGURATION ---
+DEFAULT_URL = "http://localhost:5000"
 
 # Send ONLY the parameters you want to change (e.g., just the output folder)
-payload = {
-    "CLASSIFICATION_FOLDER": "C:/Users/User/OneDrive/Desktop/TEST"
-}
+DEFAULT_PAYLOAD = {"CLASSIFICATION_FOLDER": "C:/Users/User/OneDrive/Desktop/TEST"}
+
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+# Responses worth retrying; anything else (e.g. a 400 from the preflight) is final
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# A submission may already be queued when the server answers 5xx, so POSTs
+# are only retried when the server turned the request away before any work
+POST_RETRY_STATUS_CODES = (429, 503)
+REQUEST_TIMEOUT = 30
+REPORT_FIELDS = [
+    "index", "job_id", "status", "http_status", "deduplicated", "retries",
+    "submit_seconds", "queue_seconds", "run_seconds", "total_seconds", "message",
+]
+
+local = threading.local()
+
+
+# --- 2. SPEC LOADING ---
+def parse_value(text):
+    """Parse a CSV cell or --param value as JSON, falling back to the plain string"""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def load_spec(path):
+    """Read a list of request payloads from a JSON or CSV file"""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            return [
+                {key: parse_value(value) for key, value in row.items() if value not in ("", None)}
+                for row in csv.DictReader(f)
+            ]
+        spec = json.load(f)
+    if isinstance(spec, dict):
+        spec = spec.get("jobs", [])
+    if not isinstance(spec, list) or not all(isinstance(job, dict) for job in spec):
+        raise ValueError("A JSON spec must be a list of parameter objects")
+    return spec
+
+
+def parse_param(text):
+    key, separator, value = text.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError(f"Expected KEY=VALUE, got {text!r}")
+    return key, parse_value(value)
+
+
+# --- 3. SUBMIT AND FOLLOW ---
+def session():
+    """One HTTP session per thread, so connections are reused"""
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+    return local.session
+
+
+def never_sent(error):
+    """True when the connection was never made, so resending cannot submit a job twice"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def request_with_retries(method, url, retries, **kwargs):
+    """
+    Send a request, retrying connection errors and 429/5xx with backoff. A POST
+    is not idempotent, so it is only retried when it never reached the server
+    or was refused with 429/503. Returns (response, retries used).
+    """
+    retry_codes = POST_RETRY_STATUS_CODES if method == "POST" else RETRY_STATUS_CODES
+    for attempt in range(retries + 1):
+        try:
+            response = session().request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+            if response.status_code not in retry_codes or attempt == retries:
+                return response, attempt
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == retries or (method == "POST" and not never_sent(e)):
+                raise
+        time.sleep(min(0.5 * 2**attempt, 10))
+
+
+def run_job(index, payload, args):
+    """Submit one job, follow it until it ends and return its timings"""
+    record = dict.fromkeys(REPORT_FIELDS)
+    record["index"] = index
+    started = time.time()
+    try:
+        response, record["retries"] = request_with_retries(
+            "POST", f"{args.url}/jobs", args.retries, json=payload
+        )
+        record["submit_seconds"] = round(time.time() - started, 3)
+        record["http_status"] = response.status_code
+        body = response.json()
+        if response.status_code not in (200, 202):
+            record["status"] = "rejected"
+            record["message"] = body.get("message")
+            return record
+
+        job = body
+        record["job_id"] = job["job_id"]
+        record["deduplicated"] = job.get("deduplicated")
+        deadline = started + args.timeout
+        while not args.no_wait and job["status"] not in TERMINAL_STATUSES:
+            if time.time() > deadline:
+                job["status"] = "timeout"
+                break
+            time.sleep(args.poll_interval)
+            response, retries = request_with_retries(
+                "GET", f"{args.url}/jobs/{record['job_id']}", args.retries
+            )
+            record["retries"] += retries
+            job = response.json()
+
+        record["status"] = job["status"]
+        record["message"] = job.get("message")
+        if job.get("started_at"):
+            record["queue_seconds"] = round(job["started_at"] - job["created_at"], 3)
+        if job.get("started_at") and job.get("finished_at"):
+            record["run_seconds"] = round(job["finished_at"] - job["started_at"], 3)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        record["status"] = "error"
+        record["message"] = str(e)
+    finally:
+        record["total_seconds"] = round(time.time() - started, 3)
+    return record
+
+
+# --- 4. REPORTING ---
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def print_summary(records, wall_seconds):
+    # A deduplicated submission was answered by an earlier identical job, whose
+    # timings it would only repeat, so it is counted apart from the jobs run
+    deduplicated = sum(1 for record in records if record["deduplicated"])
+    records = [record for record in records if not record["deduplicated"]]
+    counts = {}
+    for record in records:
+        counts[record["status"]] = counts.get(record["status"], 0) + 1
+    print()
+    print(f"Jobs: {len(records)}  " + "  ".join(f"{k}: {v}" for k, v in sorted(counts.items())))
+    if deduplicated:
+        print(
+            f"Deduplicated: {deduplicated} submission(s) matched an earlier identical job and are"
+            " left out of the figures below; use --unique to run every one"
+        )
+    succeeded = counts.get("succeeded", 0)
+    print(
+        f"Wall time: {wall_seconds:.1f} s  "
+        f"Throughput: {60 * succeeded / wall_seconds:.2f} succeeded jobs/min"
+    )
+
+    if not succeeded:
+        return
+    print(f"{'Latency (s)':<14}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'n':>6}")
+    for field, label in (
+        ("submit_seconds", "submit"),
+        ("queue_seconds", "queue wait"),
+        ("run_seconds", "run"),
+        ("total_seconds", "end to end"),
+    ):
+        values = [r[field] for r in records if r[field] is not None and r["status"] == "succeeded"]
+        if not values:
+            continue
+        row = "".join(f"{percentile(values, q):>9.2f}" for q in (0.5, 0.9, 0.99))
+        print(f"{label:<14}{row}{max(values):>9.2f}{len(values):>6}")
+
+
+def write_report(records, path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(sorted(records, key=lambda r: r["index"]))
+    print(f"Per-job report written to {path}")
+
+
+# --- 5. MAIN ---
+def main():
+    parser = argparse.ArgumentParser(description="Submit classification jobs to the QGIS ML server.")
+    parser.add_argument("--url", default=DEFAULT_URL, help="server URL (default %(default)s)")
+    parser.add_argument("--spec", help="JSON or CSV file of request payloads")
+    parser.add_argument(
+        "--param", action="append", type=parse_param, default=[], metavar="KEY=VALUE",
+        help="parameter added to every request; may be repeated",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="submit the spec this many times")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="start at most this many jobs per second")
+    parser.add_argument("--retries", type=int, default=3, help="retries per HTTP request")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between status polls")
+    parser.add_argument("--timeout", type=float, default=3600, help="give up following a job after this many seconds")
+    parser.add_argument("--unique", action="store_true", help="send FORCE_RERUN and turn off USE_MODEL_CACHE so every job trains and runs in full")
+    parser.add_argument("--no-wait", action="store_true", help="only submit, do not follow the jobs")
+    parser.add_argument("--report", help="write per-job timings to this CSV file")
+    args = parser.parse_args()
+    args.url = args.url.rstrip("/")
+
+    spec = load_spec(args.spec) if args.spec else [DEFAULT_PAYLOAD]
+    payloads = []
+    for _ in range(args.repeat):
+        for job in spec:
+            payload = {**job, **dict(args.param)}
+            if args.unique:
+                payload["FORCE_RERUN"] = True
+                payload["USE_MODEL_CACHE"] = False
+            payloads.append(payload)
+
+    print(f"Submitting {len(payloads)} job(s) to {args.url} with concurrency {args.concurrency}")
+    records = []
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = []
+        for index, payload in enumerate(payloads):
+            if args.rate:
+                time.sleep(max(0.0, started + index / args.rate - time.time()))
+            futures.append(executor.submit(run_job, index, payload, args))
+
+        for future in as_completed(futures):
+            record = future.result()
+            records.append(record)
+            timings = ", ".join(
+                f"{label} {record[field]:.1f}s"
+                for field, label in (("queue_seconds", "queue"), ("run_seconds", "run"), ("total_seconds", "total"))
+                if record[field] is not None
+            )
+            if record["deduplicated"]:
+                timings += f", deduplicated ({record['deduplicated']})"
+            print(
+                f"[{len(records)}/{len(payloads)}] job {record['job_id'] or '-'} {record['status']}"
+                f" ({timings})" + (f": {record['message']}" if record["status"] != "succeeded" and record["message"] else "")
+            )
+
+    print_summary(records, time.time() - started)
+    if args.report:
+        write_report(records, args.report)
+    # Without --no-wait every job should have finished; with it, been accepted
+    accepted = ("succeeded",) if not args.no_wait else ("succeeded", "queued", "running")
+    return 0 if all(r["status"] in accepted for r in records) else 1
+
 
-response = requests.post(url, json=payload)
-print(response.json())
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,28 +3,217 @@ import os
 import importlib.util
 import multiprocessing
 import json
+import hashlib
+import itertools
+import math
+import re
+import signal
+import sqlite3
+import statistics
+import threading
+import time
+import shutil
+import uuid
 import boto3  # <--- AWS SDK
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from flask import Flask, request, jsonify
-from qgis.core import (
-    QgsApplication, 
-    QgsProcessingContext, 
-    QgsProcessingFeedback
-)
+from flask import Flask, Response, request, jsonify, stream_with_context
+
+# Stand-in mode runs the server without QGIS for load testing (see standin.py)
+STANDIN_MODE = os.environ.get("QGIS_ML_STANDIN", "0") == "1"
+if STANDIN_MODE:
+    from standin import Qgis, QgsApplication, QgsProcessingContext, QgsProcessingFeedback
+else:
+    from qgis.core import (
+        Qgis,
+        QgsApplication, 
+        QgsProcessingContext, 
+        QgsProcessingFeedback
+    )
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    if not STANDIN_MODE:
+        raise
+    # Without GDAL, tiling, COG conversion, the band stack cache and band checks are off
+    gdal = osr = None
 
 # --- 1. CONFIGURATION ---
 app = Flask(__name__)
+if gdal is not None:
+    gdal.UseExceptions()
 
-# Global variable to hold the SINGLE instance of your algorithm
+# Global variable to hold the SINGLE instance of your algorithm (one per worker process)
 LOADED_ALG = None 
+# Pool slot of the current worker process (None in the Flask process)
+WORKER_SLOT = None
+# Band stack of the last job this worker ran, used to prefer jobs on the same inputs
+LAST_INPUT_KEY = None
+# QGIS version and classification script checksum of this worker, stored on each job it runs
+QGIS_VERSION = None
+SCRIPT_VERSION = None
+
+# --- JOB QUEUE CONFIGURATION ---
+# Jobs are persisted in SQLite so queued work survives a server restart
+JOB_DB_PATH = os.environ.get(
+    "QGIS_ML_JOB_DB", str(Path(__file__).with_name("qgis-ml-jobs.sqlite3"))
+)
+WORKER_POLL_SECONDS = 1.0
+# A worker prefers queued jobs on the band stack it just read, but only among
+# jobs submitted within this many seconds of the oldest one, so nothing starves
+INPUT_AFFINITY_WINDOW_SECONDS = 120
+MAX_BATCH_VARIANTS = 100
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+# --- PROGRESS CONFIGURATION ---
+# SCP reports progress many times a second; database writes are throttled to this
+FEEDBACK_WRITE_SECONDS = 1.0
+EVENT_POLL_SECONDS = 1.0
+EVENT_HEARTBEAT_SECONDS = 15.0
+LONG_POLL_MAX_SECONDS = 30.0
+
+# --- WORKER POOL CONFIGURATION ---
+# Each worker is a separate process with its own QgsApplication, so runs
+# scale across cores. Every worker holds a full QGIS + SCP instance in memory.
+QGIS_WORKER_COUNT = int(os.environ.get("QGIS_ML_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+SUPERVISOR_POLL_SECONDS = 2.0
+# A worker that crashes is restarted after a delay that doubles with each
+# crash in a row, and its slot is given up on after WORKER_MAX_RESTARTS.
+# Running WORKER_STABLE_SECONDS without crashing resets the count.
+WORKER_MAX_RESTARTS = 5
+WORKER_RESTART_MAX_DELAY_SECONDS = 300
+WORKER_STABLE_SECONDS = 300
+
+# --- REQUEST OPTIONS ---
+# Parameters holding input file paths; their size and mtime are part of a request's fingerprint
+INPUT_FILE_PARAMS = ('BAND_INPUT_LAYERS', 'TRAINING_INPUT_SCPX', 'TESTING_INPUT_SCPX', 'CLASSIFIER_INPUT_RSMO')
+# Keys a client may send that steer the server and are never passed to the algorithm
+SERVER_OPTIONS = {
+    'FORCE_RERUN': False,  # ignore previous results for identical requests
+    'USE_MODEL_CACHE': True,  # reuse a cached trained classifier when one matches
+    'TILE_SIZE': 0,  # classify the scene in tiles of this many pixels (0 = one job)
+}
+
+# --- MODEL CACHE CONFIGURATION ---
+# Trained classifiers (.rsmo) keyed by training file, algorithm and hyperparameters
+MODEL_CACHE_DIR = Path(os.environ.get(
+    "QGIS_ML_MODEL_CACHE", str(Path(__file__).with_name("model-cache"))
+))
+# Parameters that change the trained model, shared by every algorithm
+MODEL_COMMON_PARAMS = (
+    'ML_MODEL', 'USE_MACROCLASS', 'MC_OR_CLASS_FIELD', 'NORMALIZATION', 'NODATA',
+    'SINGLE_THRESHOLD', 'SIGNATURE_THRESHOLD', 'CROSS_VALIDATION', 'FIND_BEST_ESTIMATOR',
+)
+# Hyperparameters per ML_MODEL index (see ML_MODEL_OPTIONS in the frontend)
+MODEL_HYPERPARAMS = {
+    3: ('RF_TREES', 'RF_SPLIT', 'RF_MAX_FEATURES', 'RF_ONE_VS_REST', 'BALANCED_CLASS_WEIGHT'),
+    4: ('SVM_REGULARIZATION', 'SVM_KERNEL', 'SVM_GAMMA', 'BALANCED_CLASS_WEIGHT'),
+    5: ('MLP_LAYERS', 'MLP_MAX_ITER', 'MLP_ACTIVATION', 'MLP_APLHA', 'MLP_TRAIN_PORTION',
+        'MLP_BATCH_SIZE', 'MLP_LEARNING_RATE_INIT'),
+    6: ('MLP_LAYERS', 'MLP_MAX_ITER', 'MLP_ACTIVATION', 'MLP_APLHA', 'MLP_TRAIN_PORTION',
+        'MLP_BATCH_SIZE', 'MLP_LEARNING_RATE_INIT'),
+}
+
+# Path of the SCP classification script each worker loads
+SCP_SCRIPT_PATH = os.environ.get(
+    "SCP_SCRIPT_PATH",
+    r'C:\Users\User\AppData\Roaming\QGIS\QGIS3\profiles\default\processing\scripts\scp-classification.py'
+)
+
+# --- BAND STACK CACHE CONFIGURATION ---
+# The bands of a scene are copied once into a single tiled, pixel-interleaved
+# GeoTIFF on local disk, keyed by band paths, sizes and mtimes. Runs read that
+# one file through per-band VRTs instead of the separate (often cloud-synced) band files
+# Off by default in stand-in mode, whose band files need not be rasters
+BAND_STACK_CACHE = gdal is not None and os.environ.get(
+    "QGIS_ML_BAND_STACK_CACHE", "0" if STANDIN_MODE else "1"
+) == "1"
+BAND_STACK_DIR = Path(os.environ.get(
+    "QGIS_ML_BAND_STACK_DIR", str(Path(__file__).with_name("band-stack-cache"))
+))
+# Least recently used stacks are removed beyond this total size
+BAND_STACK_MAX_BYTES = int(float(os.environ.get("QGIS_ML_BAND_STACK_MAX_GB", 20)) * 1024 ** 3)
+BAND_STACK_CREATION_OPTIONS = [
+    'TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'INTERLEAVE=PIXEL', 'BIGTIFF=IF_SAFER'
+]
+
+# --- TILING CONFIGURATION ---
+# A tiled run classifies overlapping windows of the scene as separate jobs on
+# the worker pool, so memory per worker is bounded by the tile size, then
+# mosaics the tiles' core windows back into one raster
+TILE_WORK_DIR = Path(os.environ.get(
+    "QGIS_ML_TILE_DIR", str(Path(__file__).with_name("tile-work"))
+))
+TILE_OVERLAP_PIXELS = 32
+MIN_TILE_SIZE = 256
+
+# --- PREFLIGHT CONFIGURATION ---
+# Requests are checked from raster headers before they are queued. A scene whose
+# estimated working memory exceeds this budget is tiled when a classifier is available
+MAX_JOB_MEMORY_MB = int(os.environ.get("QGIS_ML_MAX_JOB_MEMORY_MB", 4096))
+# Rough SCP working set per band per pixel: the band as float64 for the model
+BYTES_PER_BAND_PIXEL = 8
+# Runtime estimates use the median seconds per pixel of this many recent runs
+RUNTIME_HISTORY_JOBS = 20
+
+# --- METRICS CONFIGURATION ---
+# Metric label per ML_MODEL index (see ML_MODEL_OPTIONS in the frontend)
+ALGORITHM_NAMES = {
+    0: 'minimum_distance', 1: 'maximum_likelihood', 2: 'spectral_angle_mapping',
+    3: 'random_forest', 4: 'svm', 5: 'mlp', 6: 'pytorch_mlp',
+}
+# Histogram buckets, in seconds, for queue wait and phase durations
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+# --- COG CONFIGURATION ---
+# Output rasters are rewritten as Cloud Optimised GeoTIFFs before upload, so
+# readers can fetch a window or an overview with HTTP range requests
+CONVERT_OUTPUTS_TO_COG = gdal is not None and os.environ.get(
+    "QGIS_ML_COG", "0" if STANDIN_MODE else "1"
+) == "1"
+COG_BLOCK_SIZE = 512
+COG_CREATION_OPTIONS = ['COMPRESS=DEFLATE', f'BLOCKSIZE={COG_BLOCK_SIZE}', 'BIGTIFF=IF_SAFER']
 
 # --- AWS CONFIGURATION ---
 S3_BUCKET_NAME = os.environ.get("MY_S3_BUCKET_NAME", "default-bucket-name")
 
+# Files are uploaded in parallel; large rasters additionally go up in parallel parts
+S3_UPLOAD_THREADS = int(os.environ.get("S3_UPLOAD_THREADS", 8))
+S3_UPLOAD_RETRIES = 3
+# HEAD errors meaning "nothing to compare against": the object is missing, or the
+# credentials may only put objects
+S3_HEAD_UPLOAD_ANYWAY_CODES = ('404', 'NoSuchKey', 'NotFound', '403', 'AccessDenied', 'Forbidden')
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=4,
+)
+
 # Initialize S3 Client without hardcoded keys
 # It will automatically pick up the credentials from the environment variables 
 # we will set in the .bat file.
-s3_client = boto3.client('s3')
+if os.environ.get("S3_LOCAL_DIR"):
+    # Local folder standing in for S3, for load tests (see standin.py)
+    from standin import LocalS3Client
+    s3_client = LocalS3Client(
+        os.environ["S3_LOCAL_DIR"], float(os.environ.get("S3_LOCAL_MBPS", 0))
+    )
+else:
+    # One pooled connection per part that can be in flight at once; the
+    # default pool of 10 would be exhausted and connections reopened
+    s3_client = boto3.client('s3', config=Config(
+        max_pool_connections=S3_UPLOAD_THREADS * S3_TRANSFER_CONFIG.max_concurrency
+    ))
+
+# When enabled, a job is marked succeeded as soon as QGIS finishes and its
+# outputs are uploaded while the worker moves on to the next job
+S3_UPLOAD_IN_BACKGROUND = os.environ.get("S3_UPLOAD_IN_BACKGROUND", "0") == "1"
+# Per worker process; only used when S3_UPLOAD_IN_BACKGROUND is enabled
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=1)
 
 DEFAULT_PARAMS = {
     'BAND_INPUT_LAYERS': [
@@ -73,100 +262,2129 @@ DEFAULT_PARAMS = {
 }
 
 # --- 2. HELPER FUNCTIONS ---
+def file_md5(file_path):
+    """MD5 of a file, read in chunks so large rasters are not loaded into memory."""
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def upload_file_to_s3(file_path, s3_bucket, s3_key):
+    """
+    Uploads one file, retrying on failure. Returns 'skipped' when S3 already
+    holds an object with the same size and checksum, otherwise 'uploaded'.
+    The checksum is kept in the object metadata because multipart ETags are not MD5s.
+    """
+    size = file_path.stat().st_size
+    md5 = file_md5(file_path)
+
+    for attempt in range(1, S3_UPLOAD_RETRIES + 1):
+        try:
+            try:
+                head = s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+                if head['ContentLength'] == size and head.get('Metadata', {}).get('md5') == md5:
+                    return 'skipped'
+            except ClientError as e:
+                # Without s3:ListBucket (or s3:GetObject) S3 answers 403 rather than 404,
+                # so the object cannot be compared and is uploaded as before
+                if e.response['Error']['Code'] not in S3_HEAD_UPLOAD_ANYWAY_CODES:
+                    raise
+
+            s3_client.upload_file(
+                str(file_path), s3_bucket, s3_key,
+                ExtraArgs={'Metadata': {'md5': md5}},
+                Config=S3_TRANSFER_CONFIG
+            )
+            return 'uploaded'
+        except Exception as e:
+            if attempt == S3_UPLOAD_RETRIES:
+                raise
+            print(f"Upload of {file_path.name} failed (attempt {attempt}): {e}. Retrying...")
+            time.sleep(2 ** attempt)
+
+
 def upload_folder_to_s3(local_folder_path, s3_bucket):
     """
-    Recursively uploads a folder and its contents to S3.
+    Recursively uploads a folder and its contents to S3, several files at a time.
     Preserves the folder name as the S3 prefix.
+    Returns a summary of uploaded, skipped and failed files.
     """
+    summary = {"uploaded": [], "skipped": [], "failed": [], "bytes_uploaded": 0, "seconds": 0.0}
+
     folder = Path(local_folder_path)
     if not folder.exists():
         print(f"Warning: Folder {local_folder_path} does not exist. Skipping upload.")
-        return
+        return summary
 
     print(f"Starting upload for folder: {folder.name}")
-    
-    # Walk through all files in the directory
-    for file_path in folder.rglob('*'):
-        if file_path.is_file():
-            # Create S3 Key: FolderName/FileName (e.g., RandomForest-2025/classification.tif)
-
-            # relative_to(folder.parent) keeps the main folder name in the S3 path
-            # We manually add 'data_storage/' at the beginning of the path
-            s3_key = f"data_storage/{file_path.relative_to(folder.parent)}".replace("\\", "/")
-            
-            print(f"Uploading {file_path.name} -> s3://{s3_bucket}/{s3_key}")
+    started = time.time()
+
+    # Create S3 Key: FolderName/FileName (e.g., RandomForest-2025/classification.tif)
+    # relative_to(folder.parent) keeps the main folder name in the S3 path
+    # We manually add 'data_storage/' at the beginning of the path
+    files = {
+        file_path: f"data_storage/{file_path.relative_to(folder.parent)}".replace("\\", "/")
+        for file_path in folder.rglob('*') if file_path.is_file()
+    }
+
+    with ThreadPoolExecutor(max_workers=S3_UPLOAD_THREADS) as executor:
+        futures = {
+            executor.submit(upload_file_to_s3, file_path, s3_bucket, s3_key): file_path
+            for file_path, s3_key in files.items()
+        }
+        for future, file_path in futures.items():
+            name = file_path.relative_to(folder).as_posix()
             try:
-                s3_client.upload_file(str(file_path), s3_bucket, s3_key)
+                outcome = future.result()
             except Exception as e:
-                print(f"Failed to upload {file_path.name}: {e}")
+                print(f"Failed to upload {name}: {e}")
+                summary["failed"].append({"file": name, "error": str(e)})
+                continue
+
+            print(f"{outcome.capitalize()} {name} -> s3://{s3_bucket}/{files[file_path]}")
+            summary[outcome].append(name)
+            if outcome == 'uploaded':
+                summary["bytes_uploaded"] += file_path.stat().st_size
+
+    summary["seconds"] = round(time.time() - started, 2)
+    return summary
+
+
+def describe_upload(summary):
+    message = f"Uploaded {len(summary['uploaded'])} file(s) to S3, {len(summary['skipped'])} already up to date"
+    if summary["failed"]:
+        message += f", {len(summary['failed'])} FAILED"
+    return message
+
+
+def describe_input_file(path):
+    """Identifies an input file by path, size and modification time."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {"path": path, "missing": True}
+    return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def request_fingerprint(final_params):
+    """
+    Hash of the merged parameters plus the size and mtime of every input file,
+    so an edited band or training file never matches an earlier run.
+    """
+    files = []
+    for key in INPUT_FILE_PARAMS:
+        value = final_params.get(key)
+        paths = value if isinstance(value, list) else [value]
+        files.extend(describe_input_file(path) for path in paths if path)
+
+    payload = json.dumps({"params": final_params, "files": files}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def band_stack_key(final_params):
+    """Identifies the band files of a request, so runs on the same scene can be grouped."""
+    bands = [describe_input_file(path) for path in final_params.get('BAND_INPUT_LAYERS') or []]
+    return hashlib.sha256(json.dumps(bands, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def extract_overall_accuracy(output_folder):
+    """
+    Looks for an overall accuracy figure in the accuracy report a run wrote.
+    Returns it as a float, or None when the run produced no report.
+    """
+    pattern = re.compile(r'overall accuracy[^0-9]*([0-9]+(?:\.[0-9]+)?)', re.IGNORECASE)
+    for report in sorted(Path(output_folder).rglob('*')):
+        if not report.is_file() or 'accuracy' not in report.name.lower():
+            continue
+        if report.suffix.lower() not in ('.csv', '.txt', '.html'):
+            continue
+        match = pattern.search(report.read_text(errors='ignore'))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def band_identity(path):
+    """
+    Name of the band a file holds, taken from the last token of its file name,
+    e.g. 'B02' for clipRT_T30UXC_A053745_20251006T110612_B02.tif. The token
+    stays the same across scenes and through the band stack and tile VRTs.
+    """
+    return re.split(r'[_\-. ]', Path(path).stem)[-1].upper()
+
+
+def model_cache_key(final_params):
+    """
+    Key of the classifier a request would train. The model depends on the
+    training ROIs, the algorithm, its hyperparameters and the order of the
+    bands it is fed, not on the scene it is applied to, so band files only
+    contribute their band names.
+    """
+    ml_model = final_params.get('ML_MODEL')
+    keys = MODEL_COMMON_PARAMS + MODEL_HYPERPARAMS.get(ml_model, ())
+    payload = json.dumps({
+        "training": describe_input_file(final_params.get('TRAINING_INPUT_SCPX')),
+        "bands": [band_identity(path) for path in final_params.get('BAND_INPUT_LAYERS') or []],
+        "params": {key: final_params.get(key) for key in keys},
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def find_cached_model(cache_key, record_hit=True):
+    """Returns the path of a cached classifier for this key, or None."""
+    with job_db() as conn:
+        row = conn.execute("SELECT path FROM models WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row is None or not os.path.isfile(row['path']):
+            return None
+        if not record_hit:
+            return row['path']
+        conn.execute("UPDATE models SET hits = hits + 1, last_used_at = ? WHERE cache_key = ?",
+                     (time.time(), cache_key))
+    return row['path']
+
+
+def store_trained_model(cache_key, output_folder, final_params, job_id):
+    """Copies the classifier a run saved into the cache. Returns its cached path or None."""
+    saved_models = sorted(Path(output_folder).rglob('*.rsmo'))
+    if not saved_models:
+        return None
+
+    MODEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cached_path = MODEL_CACHE_DIR / f"{cache_key}.rsmo"
+    # Copy under a temporary name first so a reader never sees a partial file
+    temp_path = cached_path.with_suffix(f".{os.getpid()}.tmp")
+    shutil.copy2(saved_models[0], temp_path)
+    os.replace(temp_path, cached_path)
+
+    with job_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO models "
+            "(cache_key, path, ml_model, training_file, source_job_id, created_at, last_used_at, hits) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+            (cache_key, str(cached_path), final_params.get('ML_MODEL'),
+             final_params.get('TRAINING_INPUT_SCPX'), job_id, time.time(), time.time())
+        )
+    return str(cached_path)
+
+
+def read_raster_grid(path):
+    """Size and georeferencing of a raster, read from its header only."""
+    dataset = gdal.Open(path)
+    return {
+        "width": dataset.RasterXSize,
+        "height": dataset.RasterYSize,
+        "geotransform": dataset.GetGeoTransform(),
+        "projection": dataset.GetProjection(),
+    }
+
+
+def same_crs(wkt, other_wkt):
+    if not wkt or not other_wkt:
+        return wkt == other_wkt
+    return bool(osr.SpatialReference(wkt=wkt).IsSame(osr.SpatialReference(wkt=other_wkt)))
+
+
+def describe_misalignment(path, grid, reference_path, reference):
+    """Lists how a band's grid differs from the reference band (CRS, resolution, extent)."""
+    gt, ref_gt = grid['geotransform'], reference['geotransform']
+    problems = []
+    if not same_crs(grid['projection'], reference['projection']):
+        problems.append("CRS")
+    if not all(math.isclose(gt[i], ref_gt[i], rel_tol=1e-9) for i in (1, 2, 4, 5)):
+        problems.append("resolution")
+    if (grid['width'], grid['height']) != (reference['width'], reference['height']) or \
+            not all(math.isclose(gt[i], ref_gt[i], rel_tol=1e-9) for i in (0, 3)):
+        problems.append("extent")
+    if not problems:
+        return None
+    return f"{path} differs from {reference_path} in {', '.join(problems)}"
+
+
+def plan_tiles(band_paths, tile_size, overlap):
+    """
+    Splits the scene into tiles. The core windows of the tiles cover the scene
+    exactly once; each tile is read with `overlap` extra pixels on every side.
+    Windows are [xoff, yoff, xsize, ysize] in pixels.
+    """
+    if not band_paths:
+        raise ValueError("BAND_INPUT_LAYERS is empty")
+    grid = read_raster_grid(band_paths[0])
+    for path in band_paths[1:]:
+        problem = describe_misalignment(path, read_raster_grid(path), band_paths[0], grid)
+        if problem:
+            raise ValueError(problem)
+
+    width, height = grid["width"], grid["height"]
+    tiles = []
+    for core_y in range(0, height, tile_size):
+        for core_x in range(0, width, tile_size):
+            core = [core_x, core_y, min(tile_size, width - core_x), min(tile_size, height - core_y)]
+            x0, y0 = max(0, core_x - overlap), max(0, core_y - overlap)
+            x1 = min(width, core_x + core[2] + overlap)
+            y1 = min(height, core_y + core[3] + overlap)
+            tiles.append({"index": len(tiles), "window": [x0, y0, x1 - x0, y1 - y0], "core": core})
+    return tiles
+
+
+def build_tile_bands(band_paths, window, bands_folder):
+    """Writes a VRT per band that exposes only the tile's window, so SCP reads no more."""
+    bands_folder.mkdir(parents=True, exist_ok=True)
+    tile_bands = []
+    for position, path in enumerate(band_paths):
+        vrt_path = bands_folder / f"{position:02d}-{Path(path).stem}.vrt"
+        gdal.Translate(str(vrt_path), path, format='VRT', srcWin=window)
+        tile_bands.append(str(vrt_path))
+    return tile_bands
+
+
+def estimate_stack_bytes(band_paths):
+    """Uncompressed size of a band stack, from the first band's header."""
+    dataset = gdal.Open(band_paths[0])
+    sample_bytes = gdal.GetDataTypeSize(dataset.GetRasterBand(1).DataType) // 8
+    return dataset.RasterXSize * dataset.RasterYSize * sample_bytes * len(band_paths)
+
+
+def band_stack_mismatch(band_paths):
+    """
+    A stack GeoTIFF has one data type and one nodata value for all its bands
+    and the stack takes only the first band of each file. Returns why the
+    bands cannot share a stack, or None when they can.
+    """
+    layouts = set()
+    for path in band_paths:
+        dataset = gdal.Open(path)
+        if dataset.RasterCount != 1:
+            return f"{Path(path).name} has {dataset.RasterCount} bands"
+        band = dataset.GetRasterBand(1)
+        # repr so that NaN nodata values compare equal
+        layouts.add((gdal.GetDataTypeName(band.DataType), repr(band.GetNoDataValue())))
+    if len(layouts) > 1:
+        return "Bands differ in data type or nodata value"
+    return None
+
+
+def build_band_stack(band_paths, stack_folder):
+    """
+    Writes the bands into one tiled, pixel-interleaved GeoTIFF, so a block of
+    every band is a single sequential read, plus a VRT per band that SCP takes
+    in place of the original file. Returns the band VRT paths.
+    """
+    stack_folder.mkdir(parents=True, exist_ok=True)
+    stack_path = stack_folder / 'stack.tif'
+    sources_vrt = stack_folder / 'sources.vrt'
+    temp_path = stack_folder / 'stack.tif.tmp'
+
+    gdal.BuildVRT(str(sources_vrt), band_paths, separate=True)
+    gdal.Translate(str(temp_path), str(sources_vrt), format='GTiff',
+                   creationOptions=BAND_STACK_CREATION_OPTIONS)
+    os.replace(temp_path, stack_path)
+    sources_vrt.unlink()
+
+    wrappers = []
+    for position, path in enumerate(band_paths):
+        vrt_path = stack_folder / f"{position:02d}-{Path(path).stem}.vrt"
+        gdal.Translate(str(vrt_path), str(stack_path), format='VRT', bandList=[position + 1])
+        wrappers.append(str(vrt_path))
+    return wrappers
+
+
+def cog_creation_options(dataset):
+    """
+    COG options for a raster. Class rasters get nearest-neighbour overviews so
+    every overview pixel is still a valid class; continuous rasters such as
+    confidence are averaged and use the floating point predictor.
+    """
+    data_type = gdal.GetDataTypeName(dataset.GetRasterBand(1).DataType)
+    if data_type.startswith('Float'):
+        return COG_CREATION_OPTIONS + ['PREDICTOR=YES', 'OVERVIEW_RESAMPLING=AVERAGE']
+    return COG_CREATION_OPTIONS + ['OVERVIEW_RESAMPLING=NEAREST']
+
+
+def validate_cog(path, source):
+    """Raises RuntimeError unless path is a tiled COG of the same size as source, with overviews."""
+    dataset = gdal.Open(str(path))
+    band = dataset.GetRasterBand(1)
+    problems = []
+    if dataset.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') != 'COG':
+        problems.append("layout is not COG")
+    if (dataset.RasterXSize, dataset.RasterYSize) != (source.RasterXSize, source.RasterYSize):
+        problems.append("size differs from the source")
+    if band.GetBlockSize() != [COG_BLOCK_SIZE, COG_BLOCK_SIZE]:
+        problems.append(f"blocks are {band.GetBlockSize()}, not internal tiles")
+    if max(dataset.RasterXSize, dataset.RasterYSize) > COG_BLOCK_SIZE and band.GetOverviewCount() == 0:
+        problems.append("no overviews")
+    if problems:
+        raise RuntimeError(f"{path.name} is not a valid COG: {', '.join(problems)}")
+
+
+def convert_to_cog(path):
+    """
+    Rewrites a GeoTIFF in place as a Cloud Optimised GeoTIFF with internal
+    tiling, compression and overviews. Returns False if it already was one.
+    """
+    source = gdal.Open(str(path))
+    if source.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') == 'COG':
+        return False
+
+    temp_path = path.with_name(f".{path.stem}.cog.tmp")
+    try:
+        gdal.Translate(str(temp_path), source, format='COG', creationOptions=cog_creation_options(source))
+        validate_cog(temp_path, source)
+    except Exception:
+        temp_path.unlink(missing_ok=True)
+        raise
+    # Close the source first, Windows cannot replace an open file
+    source = None
+    os.replace(temp_path, path)
+    return True
+
+
+def convert_outputs_to_cog(output_folder, feedback):
+    """
+    Converts every GeoTIFF in a run's output folder to a COG. A raster that
+    fails to convert is uploaded as SCP wrote it. Returns the number converted.
+    """
+    rasters = sorted(
+        path for path in Path(output_folder).rglob('*')
+        if path.is_file() and path.suffix.lower() in ('.tif', '.tiff')
+    )
+    converted = 0
+    for position, path in enumerate(rasters):
+        feedback.setProgressText(f"Converting {path.name} to a Cloud Optimised GeoTIFF")
+        try:
+            converted += convert_to_cog(path)
+        except Exception as e:
+            feedback.pushWarning(f"Could not convert {path.name} to COG, uploading it as is: {e}")
+        feedback.setProgress(100.0 * (position + 1) / len(rasters))
+    return converted
+
+
+def mosaic_rasters(tile_rasters, output_path, progress=None):
+    """
+    Mosaics tile outputs into one raster. tile_rasters holds (path, window, core)
+    per tile; only each tile's core window is used, so overlaps never compete
+    and pixels that are nodata in their tile stay nodata in the mosaic.
+    """
+    work_folder = output_path.parent / f".{output_path.stem}-mosaic"
+    work_folder.mkdir(parents=True, exist_ok=True)
+    try:
+        core_vrts = []
+        for position, (path, window, core) in enumerate(tile_rasters):
+            local_core = [core[0] - window[0], core[1] - window[1], core[2], core[3]]
+            core_vrt = work_folder / f"core-{position:04d}.vrt"
+            gdal.Translate(str(core_vrt), str(path), format='VRT', srcWin=local_core)
+            core_vrts.append(str(core_vrt))
+
+        nodata = gdal.Open(core_vrts[0]).GetRasterBand(1).GetNoDataValue()
+        vrt_options = {} if nodata is None else {'srcNodata': nodata, 'VRTNodata': nodata}
+        mosaic_vrt = work_folder / "mosaic.vrt"
+        gdal.BuildVRT(str(mosaic_vrt), core_vrts, **vrt_options)
+
+        def report(complete, message, data):
+            if progress is not None:
+                progress(complete * 100)
+            return 1
+
+        # Written straight as a COG, so the conversion before upload has nothing to do
+        gdal.Translate(
+            str(output_path), str(mosaic_vrt), format='COG',
+            creationOptions=cog_creation_options(gdal.Open(str(mosaic_vrt))), callback=report
+        )
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return str(output_path)
+
+
+def find_band_stack(cache_key):
+    """Returns the band VRTs of a ready cached band stack, or None."""
+    with job_db() as conn:
+        row = conn.execute(
+            "SELECT wrappers FROM band_stacks WHERE cache_key = ? AND status = 'ready'", (cache_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        wrappers = json.loads(row['wrappers'])
+        if not all(os.path.isfile(path) for path in wrappers):
+            conn.execute("DELETE FROM band_stacks WHERE cache_key = ?", (cache_key,))
+            return None
+        conn.execute("UPDATE band_stacks SET hits = hits + 1, last_used_at = ? WHERE cache_key = ?",
+                     (time.time(), cache_key))
+    return wrappers
+
+
+def claim_band_stack_build(cache_key, band_paths):
+    """Reserves building a stack, so two workers never build the same one. Returns False if taken."""
+    with job_db() as conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO band_stacks (cache_key, status, band_paths, created_at, builder_pid) "
+            "VALUES (?, 'building', ?, ?, ?)",
+            (cache_key, json.dumps(band_paths), time.time(), os.getpid())
+        )
+    return cursor.rowcount == 1
+
+
+def store_band_stack(cache_key, stack_folder, wrappers):
+    size = sum(path.stat().st_size for path in stack_folder.iterdir() if path.is_file())
+    with job_db() as conn:
+        conn.execute(
+            "UPDATE band_stacks SET status = 'ready', path = ?, wrappers = ?, bytes = ?, last_used_at = ? "
+            "WHERE cache_key = ?",
+            (str(stack_folder), json.dumps(wrappers), size, time.time(), cache_key)
+        )
+
+
+def abandon_band_stack_build(cache_key, stack_folder):
+    shutil.rmtree(stack_folder, ignore_errors=True)
+    with job_db() as conn:
+        conn.execute("DELETE FROM band_stacks WHERE cache_key = ?", (cache_key,))
+
+
+def evict_band_stacks(keep):
+    """
+    Removes the least recently used band stacks until the cache fits
+    BAND_STACK_MAX_BYTES. Stacks a running job may be reading are left alone.
+    """
+    with job_db() as conn:
+        rows = conn.execute(
+            "SELECT cache_key, path, bytes FROM band_stacks WHERE status = 'ready' "
+            "ORDER BY last_used_at DESC"
+        ).fetchall()
+        in_use = {keep} | {
+            row['input_key'] for row in conn.execute(
+                "SELECT DISTINCT input_key FROM jobs WHERE status = 'running' AND input_key IS NOT NULL"
+            )
+        }
+    total = 0
+    for row in rows:
+        total += row['bytes']
+        if total <= BAND_STACK_MAX_BYTES or row['cache_key'] in in_use:
+            continue
+        try:
+            shutil.rmtree(row['path'])
+        except OSError as e:
+            # Still open by a running job (Windows); try again after the next build
+            print(f"Could not evict band stack {row['cache_key'][:12]}: {e}")
+            continue
+        with job_db() as conn:
+            conn.execute("DELETE FROM band_stacks WHERE cache_key = ?", (row['cache_key'],))
+        total -= row['bytes']
+        print(f"Evicted band stack {row['cache_key'][:12]} ({row['bytes']} bytes)")
+
+
+# --- 3. JOB STORE ---
+@contextmanager
+def job_db():
+    """Opens a connection to the job database and commits on success."""
+    conn = sqlite3.connect(JOB_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def add_missing_columns(conn, table, columns):
+    """Adds columns introduced after a database was first created."""
+    existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, declaration in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+
+
+def init_job_db():
+    """Creates the jobs table and fails any job a previous server left running."""
+    with job_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                result TEXT,
+                message TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        add_missing_columns(conn, 'jobs', {
+            'worker_slot': 'INTEGER',
+            'worker_pid': 'INTEGER',
+            'upload_status': 'TEXT',
+            'upload_summary': 'TEXT',
+            'progress': 'REAL',
+            'step': 'TEXT',
+            'cancel_requested': 'INTEGER NOT NULL DEFAULT 0',
+            'fingerprint': 'TEXT',
+            'options': 'TEXT',
+            'input_key': 'TEXT',
+            'accuracy': 'REAL',
+            'kind': "TEXT NOT NULL DEFAULT 'single'",
+            'parent_id': 'TEXT',
+            'tile': 'TEXT',
+            'pixels': 'INTEGER',
+            'qgis_version': 'TEXT',
+            'script_version': 'TEXT',
+            'trained': 'INTEGER',
+        })
+        # Wall time of each phase of a job (classification, mosaic, cog, upload)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_phases (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                seconds REAL NOT NULL,
+                outcome TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS job_phases_job ON job_phases (job_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        # Running totals behind /metrics (counters and histogram series), so a
+        # scrape never reads the job history. labels is a JSON object.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS metric_totals (
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (name, labels)
+            )
+        """)
+        # Jobs reach a final status from several places (workers, cancels,
+        # crashed workers, restarts), so finished jobs are counted by a trigger
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS jobs_finished_metrics
+            AFTER UPDATE OF status ON jobs
+            WHEN NEW.status IN ('succeeded', 'failed', 'cancelled')
+                AND OLD.status NOT IN ('succeeded', 'failed', 'cancelled')
+            BEGIN
+                INSERT INTO metric_totals (name, labels, value)
+                VALUES ('qgis_ml_jobs_finished_total',
+                        json_object('ml_model', json_extract(NEW.params, '$.ML_MODEL'),
+                                    'kind', NEW.kind, 'status', NEW.status), 1)
+                ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value;
+                INSERT INTO metric_totals (name, labels, value)
+                SELECT 'qgis_ml_pixels_classified_total',
+                       json_object('ml_model', json_extract(NEW.params, '$.ML_MODEL')), NEW.pixels
+                WHERE NEW.status = 'succeeded' AND NEW.kind != 'mosaic' AND NEW.pixels > 0
+                ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value;
+            END
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                base_params TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS batch_jobs (
+                batch_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                job_id TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                PRIMARY KEY (batch_id, position)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs (fingerprint, status)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS models (
+                cache_key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                ml_model INTEGER,
+                training_file TEXT,
+                source_job_id TEXT,
+                created_at REAL NOT NULL,
+                last_used_at REAL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS band_stacks (
+                cache_key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                band_paths TEXT NOT NULL,
+                path TEXT,
+                wrappers TEXT,
+                bytes INTEGER,
+                created_at REAL NOT NULL,
+                last_used_at REAL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        add_missing_columns(conn, 'band_stacks', {'builder_pid': 'INTEGER'})
+        # A build a previous server was running never finished
+        conn.execute("DELETE FROM band_stacks WHERE status = 'building'")
+        # Completed runs by request fingerprint, used to answer identical requests
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                fingerprint TEXT PRIMARY KEY,
+                job_id TEXT NOT NULL,
+                output_folder TEXT,
+                s3_run_id TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                level TEXT NOT NULL,
+                message TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS job_logs_job ON job_logs (job_id, id)")
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', message = ?, finished_at = ? "
+            "WHERE status = 'running'",
+            ("Server restarted while the job was running", time.time())
+        )
+        conn.execute(
+            "UPDATE jobs SET upload_status = 'interrupted' WHERE upload_status IN ('queued', 'uploading')"
+        )
+
+
+def result_is_available(conn, result):
+    """A stored result counts while its outputs still exist locally or in S3."""
+    if result['output_folder'] and os.path.isdir(result['output_folder']):
+        return True
+    job = conn.execute("SELECT upload_status FROM jobs WHERE id = ?", (result['job_id'],)).fetchone()
+    return bool(job and job['upload_status'] == 'uploaded')
+
+
+def submit_job(final_params, options, tiles=None, tile_params=None, pixels=None):
+    """
+    Queues a classification unless an identical one already exists.
+    Returns (job_id, reused), where reused is None for a new job,
+    'completed' for a finished identical run and 'in_flight' for a queued or running one.
+    With tiles, one job per tile is queued (running with tile_params) under a
+    mosaic job that only becomes claimable once every tile has finished.
+    pixels is the scene size found by the preflight, kept for runtime estimates.
+    """
+    fingerprint = request_fingerprint(final_params)
+    with job_db() as conn:
+        # Hold the write lock so two identical submissions cannot both create a job
+        conn.execute("BEGIN IMMEDIATE")
+        if not options['FORCE_RERUN']:
+            result = conn.execute(
+                "SELECT * FROM results WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+            if result is not None and result_is_available(conn, result):
+                return result['job_id'], 'completed'
+
+            in_flight = conn.execute(
+                "SELECT id FROM jobs WHERE fingerprint = ? AND status IN ('queued', 'running') "
+                "ORDER BY created_at LIMIT 1",
+                (fingerprint,)
+            ).fetchone()
+            if in_flight is not None:
+                return in_flight['id'], 'in_flight'
+
+        job_id = uuid.uuid4().hex
+        input_key = band_stack_key(final_params)
+        created_at = time.time()
+        conn.execute(
+            "INSERT INTO jobs (id, status, params, options, fingerprint, input_key, created_at, kind, pixels) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, json.dumps(final_params), json.dumps(options), fingerprint,
+             input_key, created_at, 'mosaic' if tiles else 'single', pixels)
+        )
+        conn.executemany(
+            "INSERT INTO jobs (id, status, params, options, input_key, created_at, kind, parent_id, tile, pixels) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, 'tile', ?, ?, ?)",
+            [(uuid.uuid4().hex, json.dumps(tile_params), json.dumps(options), input_key,
+              created_at, job_id, json.dumps(tile), tile['window'][2] * tile['window'][3])
+             for tile in tiles or []]
+        )
+    return job_id, None
+
+
+def record_result(job_id, output_folder):
+    """Indexes a successful job by its fingerprint for later identical requests."""
+    with job_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO results (fingerprint, job_id, output_folder, s3_run_id, created_at) "
+            "SELECT fingerprint, id, ?, ?, ? FROM jobs WHERE id = ? AND fingerprint IS NOT NULL",
+            (output_folder, os.path.basename(output_folder) if output_folder else None,
+             time.time(), job_id)
+        )
+
+
+def claim_next_job():
+    """
+    Atomically marks the next queued job as running and returns it. Jobs on
+    the band stack this worker last read go first, while its files are still
+    in the OS cache; otherwise the oldest job wins. A mosaic job waits until
+    all of its tiles have finished.
+    """
+    global LAST_INPUT_KEY
+    with job_db() as conn:
+        # IMMEDIATE takes the write lock up front so two workers can never claim the same job
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' AND NOT EXISTS "
+            "  (SELECT 1 FROM jobs t WHERE t.parent_id = jobs.id "
+            "   AND t.status NOT IN ('succeeded', 'failed', 'cancelled')) "
+            "ORDER BY (input_key = ? AND created_at <= "
+            "  (SELECT MIN(created_at) FROM jobs WHERE status = 'queued') + ?) DESC, "
+            "created_at LIMIT 1",
+            (LAST_INPUT_KEY, INPUT_AFFINITY_WINDOW_SECONDS)
+        ).fetchone()
+        if row is None:
+            return None
+        LAST_INPUT_KEY = row['input_key']
+        started_at = time.time()
+        conn.execute(
+            "UPDATE jobs SET status = 'running', started_at = ?, worker_slot = ?, worker_pid = ?, "
+            "qgis_version = ?, script_version = ? WHERE id = ?",
+            (started_at, WORKER_SLOT, os.getpid(), QGIS_VERSION, SCRIPT_VERSION, row['id'])
+        )
+        if row['kind'] != 'mosaic':
+            add_metric_totals(conn, histogram_observation(
+                'qgis_ml_queue_wait_seconds', {'kind': row['kind']}, started_at - row['created_at']
+            ))
+        return row
+
+
+def finish_job(job_id, status, message, results=None):
+    """Records the final status of a job."""
+    with job_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, message = ?, result = ?, finished_at = ? WHERE id = ?",
+            (status, message, json.dumps(results, default=str) if results is not None else None,
+             time.time(), job_id)
+        )
+
+
+def add_metric_totals(conn, samples):
+    """Adds (name, labels, amount) samples to the running totals behind /metrics."""
+    conn.executemany(
+        "INSERT INTO metric_totals (name, labels, value) VALUES (?, ?, ?) "
+        "ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+        [(name, json.dumps(labels), amount) for name, labels, amount in samples]
+    )
+
+
+def histogram_observation(name, labels, value):
+    """The samples one observation adds to a histogram: its buckets, sum and count."""
+    samples = [(f"{name}_bucket", {**labels, 'le': str(bound)}, 1)
+               for bound in DURATION_BUCKETS if value <= bound]
+    samples.append((f"{name}_bucket", {**labels, 'le': '+Inf'}, 1))
+    samples.append((f"{name}_sum", labels, value))
+    samples.append((f"{name}_count", labels, 1))
+    return samples
+
+
+def record_job_phase(job_id, phase, started_at, seconds, outcome):
+    with job_db() as conn:
+        conn.execute(
+            "INSERT INTO job_phases (job_id, phase, started_at, seconds, outcome) VALUES (?, ?, ?, ?, ?)",
+            (job_id, phase, started_at, seconds, outcome)
+        )
+        job = conn.execute(
+            "SELECT json_extract(params, '$.ML_MODEL') AS ml_model, qgis_version, script_version "
+            "FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if job is not None:
+            add_metric_totals(conn, histogram_observation('qgis_ml_phase_seconds', {
+                'phase': phase,
+                'algorithm': algorithm_label(job['ml_model']),
+                'outcome': outcome,
+                'qgis_version': job['qgis_version'] or 'unknown',
+                'script_version': job['script_version'] or 'unknown',
+            }, seconds))
+
+
+@contextmanager
+def job_phase(job_id, phase):
+    """Times one phase of a job and records it, whether or not the phase succeeds."""
+    started_at = time.time()
+    outcome = 'failed'
+    try:
+        yield
+        outcome = 'succeeded'
+    finally:
+        try:
+            record_job_phase(job_id, phase, started_at, round(time.time() - started_at, 3), outcome)
+        except sqlite3.Error as e:
+            print(f"Could not record the {phase} phase of job {job_id}: {e}")
+
+
+def get_job_phases(job_id):
+    with job_db() as conn:
+        rows = conn.execute(
+            "SELECT phase, started_at, seconds, outcome FROM job_phases WHERE job_id = ? ORDER BY id",
+            (job_id,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def record_job_accuracy(job_id, accuracy):
+    with job_db() as conn:
+        conn.execute("UPDATE jobs SET accuracy = ? WHERE id = ?", (accuracy, job_id))
+
+
+def record_job_training(job_id, trained):
+    """Notes whether a run trains its classifier or applies an existing one, for runtime estimates."""
+    with job_db() as conn:
+        conn.execute("UPDATE jobs SET trained = ? WHERE id = ?", (int(trained), job_id))
+
+
+def update_job_upload(job_id, upload_status, summary=None):
+    with job_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET upload_status = ?, upload_summary = ? WHERE id = ?",
+            (upload_status, json.dumps(summary) if summary is not None else None, job_id)
+        )
+        if summary and 'uploaded' in summary:
+            add_metric_totals(conn, [
+                ('qgis_ml_upload_bytes_total', {}, summary.get('bytes_uploaded', 0)),
+                ('qgis_ml_upload_seconds_total', {}, summary.get('seconds', 0)),
+                ('qgis_ml_upload_files_total', {}, len(summary['uploaded'])),
+            ])
+
+
+def record_job_feedback(job_id, progress, step, log_lines):
+    """Stores progress and new log lines. Returns True if the job should be cancelled."""
+    with job_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET progress = ?, step = ? WHERE id = ?", (progress, step, job_id)
+        )
+        conn.executemany(
+            "INSERT INTO job_logs (job_id, created_at, level, message) VALUES (?, ?, ?, ?)",
+            [(job_id, created_at, level, message) for created_at, level, message in log_lines]
+        )
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return bool(row and row['cancel_requested'])
+
+
+def request_job_cancel(job_id):
+    """
+    Cancels a queued job outright, or flags a running one for its worker to stop.
+    Cancelling a tiled run does the same for each of its tiles.
+    """
+    with job_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'cancelled', message = 'Cancelled before it started', "
+            "finished_at = ? WHERE (id = ? OR parent_id = ?) AND status = 'queued'",
+            (time.time(), job_id, job_id)
+        )
+        conn.execute(
+            "UPDATE jobs SET cancel_requested = 1 WHERE (id = ? OR parent_id = ?) AND status = 'running'",
+            (job_id, job_id)
+        )
+
+
+def cancel_queued_tiles(parent_id, message):
+    """Stops the remaining tiles of a run once one of them has failed."""
+    with job_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'cancelled', message = ?, finished_at = ? "
+            "WHERE parent_id = ? AND status = 'queued'",
+            (message, time.time(), parent_id)
+        )
+
+
+def get_tile_jobs(parent_id):
+    with job_db() as conn:
+        rows = conn.execute("SELECT * FROM jobs WHERE parent_id = ?", (parent_id,)).fetchall()
+    return sorted(rows, key=lambda row: json.loads(row['tile'])['index'])
+
+
+def get_job_logs(job_id, since=0, limit=500):
+    with job_db() as conn:
+        rows = conn.execute(
+            "SELECT id, created_at, level, message FROM job_logs "
+            "WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (job_id, since, limit)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def fail_unfinished_job(job_id, message):
+    """Fails a job that is still marked running, leaving a finished one alone."""
+    with job_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', message = ?, finished_at = ? "
+            "WHERE id = ? AND status = 'running'",
+            (message, time.time(), job_id)
+        )
+
+
+def fail_jobs_of_worker(worker_pid, message):
+    """Fails whatever job a dead worker process was running, and drops any band stack it was building."""
+    with job_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', message = ?, finished_at = ? "
+            "WHERE status = 'running' AND worker_pid = ?",
+            (message, time.time(), worker_pid)
+        )
+        builds = conn.execute(
+            "SELECT cache_key FROM band_stacks WHERE status = 'building' AND builder_pid = ?", (worker_pid,)
+        ).fetchall()
+    for row in builds:
+        abandon_band_stack_build(row['cache_key'], BAND_STACK_DIR / row['cache_key'])
+
+
+def estimate_runtime(ml_model, pixels, trains):
+    """
+    Estimates the runtime of a run from the median classification seconds per
+    pixel of recent successful runs of the same algorithm that, like this one,
+    either train a classifier or only apply one. Only the classification phase
+    counts, so band stacking, COG conversion and upload speed do not skew the
+    rate. Returns (seconds, runs used), with seconds None when there is no
+    history yet.
+    """
+    with job_db() as conn:
+        rows = conn.execute(
+            "SELECT p.seconds / j.pixels AS rate FROM jobs j "
+            "JOIN job_phases p ON p.job_id = j.id AND p.phase = 'classification' "
+            "WHERE j.status = 'succeeded' AND p.outcome = 'succeeded' AND j.pixels > 0 "
+            "AND json_extract(j.params, '$.ML_MODEL') = ? AND j.trained = ? "
+            "ORDER BY j.finished_at DESC LIMIT ?",
+            (ml_model, int(trains), RUNTIME_HISTORY_JOBS)
+        ).fetchall()
+    if not rows:
+        return None, 0
+    return round(statistics.median(row['rate'] for row in rows) * pixels, 1), len(rows)
+
+
+def get_job(job_id):
+    with job_db() as conn:
+        return conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def job_to_dict(row):
+    """Converts a jobs row into the JSON returned by the API."""
+    job = {
+        "job_id": row['id'],
+        "status": row['status'],
+        "message": row['message'],
+        "result": json.loads(row['result']) if row['result'] else None,
+        "created_at": row['created_at'],
+        "started_at": row['started_at'],
+        "finished_at": row['finished_at'],
+        "worker_slot": row['worker_slot'],
+        "upload_status": row['upload_status'],
+        "upload": json.loads(row['upload_summary']) if row['upload_summary'] else None,
+        "progress": row['progress'],
+        "step": row['step'],
+        "cancel_requested": bool(row['cancel_requested']),
+        "accuracy": row['accuracy'],
+        "kind": row['kind'],
+        "parent_id": row['parent_id'],
+    }
+    if row['kind'] == 'mosaic':
+        with job_db() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE parent_id = ? GROUP BY status", (row['id'],)
+            ).fetchall())
+        job["tiles"] = counts
+        if row['status'] == 'queued':
+            # Waiting on its tiles: report their progress instead of a queue position
+            total = sum(counts.values())
+            done = sum(counts.get(status, 0) for status in TERMINAL_STATUSES)
+            job["progress"] = round(100.0 * done / total, 1) if total else 0.0
+            job["step"] = f"Classifying tiles: {done} of {total} finished"
+            return job
+    if row['status'] == 'queued':
+        with job_db() as conn:
+            job["queue_position"] = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= ?",
+                (row['created_at'],)
+            ).fetchone()[0]
+    return job
+
+
+# --- 4. QGIS WORKER ---
+class JobFeedback(QgsProcessingFeedback):
+    """
+    Feedback that records progress, the current step and log lines of a job
+    in the job database, and cancels the run when a client asks it to.
+    """
+
+    def __init__(self, job_id):
+        super().__init__()
+        self.job_id = job_id
+        self.step = None
+        self.pending_lines = []
+        self.last_write = 0.0
+        self.progressChanged.connect(lambda progress: self.sync())
+
+    def log(self, level, message):
+        self.pending_lines.append((time.time(), level, str(message)))
+        self.sync()
+
+    def sync(self, force=False):
+        now = time.time()
+        if not force and now - self.last_write < FEEDBACK_WRITE_SECONDS:
+            return
+        self.last_write = now
+        lines, self.pending_lines = self.pending_lines, []
+        try:
+            cancel = record_job_feedback(self.job_id, self.progress(), self.step, lines)
+        except sqlite3.Error as e:
+            # Never let progress reporting break the classification itself
+            print(f"Could not record progress for job {self.job_id}: {e}")
+            return
+        if cancel and not self.isCanceled():
+            print(f"Cancelling job {self.job_id} at client request")
+            self.cancel()
+
+    def setProgressText(self, text):
+        super().setProgressText(text)
+        self.step = text
+        self.log('step', text)
+
+    def pushInfo(self, info):
+        super().pushInfo(info)
+        self.log('info', info)
+
+    def pushWarning(self, warning):
+        super().pushWarning(warning)
+        self.log('warning', warning)
 
-# --- 3. FLASK ROUTE ---
+    def reportError(self, error, fatalError=False):
+        super().reportError(error, fatalError)
+        self.log('error', error)
+
+    def pushCommandInfo(self, info):
+        super().pushCommandInfo(info)
+        self.log('info', info)
+
+    def pushConsoleInfo(self, info):
+        super().pushConsoleInfo(info)
+        self.log('console', info)
+
+
+def execute_classification(final_params, feedback):
+    """Runs the algorithm. Returns its results and the run's output folder (or None)."""
+    context = QgsProcessingContext()
+
+    # Run the algorithm
+    results, success = LOADED_ALG.run(final_params, context, feedback)
+    if not success:
+        raise RuntimeError("Algorithm reported failure")
+
+    # 1. Get the path to the output raster (e.g., .../RandomForest-Date/classification.tif)
+    raster_output = results.get('RASTER_OUTPUT')
+
+    # 2. Derive the parent folder path (e.g., .../RandomForest-Date)
+    # We do this because the script creates a folder, puts files in it, and returns the file path.
+    if raster_output and os.path.exists(raster_output):
+        return results, os.path.dirname(raster_output)
+    return results, None
+
+
+def classify_tile(job, final_params, feedback):
+    """Classifies one tile of a tiled run through per-band VRTs of its window."""
+    tile = json.loads(job['tile'])
+    tile_folder = TILE_WORK_DIR / job['parent_id'] / f"tile-{tile['index']:04d}"
+    feedback.setProgressText(f"Preparing tile {tile['index'] + 1} (window {tile['window']})")
+
+    run_params = dict(final_params)
+    run_params['BAND_INPUT_LAYERS'] = build_tile_bands(
+        final_params['BAND_INPUT_LAYERS'], tile['window'], tile_folder / 'bands'
+    )
+    run_params['CLASSIFICATION_FOLDER'] = str(tile_folder)
+    return execute_classification(run_params, feedback)
+
+
+def mosaic_tiled_job(job, feedback):
+    """
+    Mosaics every raster the tiles of a run produced into one output folder.
+    Returns its results and output folder, like execute_classification.
+    """
+    tiles = get_tile_jobs(job['id'])
+    unfinished = [tile for tile in tiles if tile['status'] != 'succeeded']
+    if not tiles:
+        raise RuntimeError("Tiled run has no tiles")
+    if unfinished:
+        raise RuntimeError(
+            f"{len(unfinished)} of {len(tiles)} tile(s) did not succeed: {unfinished[0]['message']}"
+        )
+
+    folders = [Path(json.loads(tile['result'])['RASTER_OUTPUT']).parent for tile in tiles]
+    windows = [json.loads(tile['tile']) for tile in tiles]
+    raster_names = [
+        path.relative_to(folders[0]) for path in sorted(folders[0].rglob('*.tif'))
+        if all((folder / path.relative_to(folders[0])).is_file() for folder in folders)
+    ]
+    if not raster_names:
+        raise RuntimeError("The tiles produced no rasters to mosaic")
+
+    final_params = json.loads(job['params'])
+    output_folder = Path(final_params['CLASSIFICATION_FOLDER']) / f"{folders[0].name}-tiled-{job['id'][:8]}"
+    results = {'TILES': len(tiles)}
+    for position, name in enumerate(raster_names):
+        feedback.setProgressText(f"Mosaicking {name} from {len(tiles)} tiles")
+        output_path = output_folder / name
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        mosaic_rasters(
+            [(folder / name, tile['window'], tile['core']) for folder, tile in zip(folders, windows)],
+            output_path,
+            lambda percent: feedback.setProgress((position + percent / 100) * 100 / len(raster_names))
+        )
+        # Keep the classification style next to its raster
+        style = (folders[0] / name).with_suffix('.qml')
+        if style.is_file():
+            shutil.copy2(style, output_path.with_suffix('.qml'))
+        results.setdefault('RASTER_OUTPUT', str(output_path))
+
+    shutil.rmtree(TILE_WORK_DIR / job['id'], ignore_errors=True)
+    return results, str(output_folder)
+
+
+def clean_tile_work_dir():
+    """Removes tile outputs of runs that are no longer queued or running."""
+    if not TILE_WORK_DIR.is_dir():
+        return
+    for folder in TILE_WORK_DIR.iterdir():
+        job = get_job(folder.name)
+        if job is None or job['status'] in TERMINAL_STATUSES:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def upload_job_outputs(job_id, output_folder):
+    """Uploads a job's output folder and records the outcome on the job."""
+    update_job_upload(job_id, 'uploading')
+    try:
+        with job_phase(job_id, 'upload'):
+            summary = upload_folder_to_s3(output_folder, S3_BUCKET_NAME)
+    except Exception as e:
+        print(f"Upload for job {job_id} failed: {e}")
+        update_job_upload(job_id, 'failed', {"error": str(e)})
+        raise
+    update_job_upload(job_id, 'failed' if summary["failed"] else 'uploaded', summary)
+    return summary
+
+
+def job_options(job):
+    """Server options of a job, filled in with defaults for older jobs."""
+    options = dict(SERVER_OPTIONS)
+    options.update(json.loads(job['options'] or '{}'))
+    return options
+
+
+def apply_model_cache(final_params, feedback):
+    """
+    Injects a cached classifier when one matches, otherwise makes sure the run
+    saves the model it trains. Returns (run_params, cache_key, cache_hit).
+    """
+    run_params = dict(final_params)
+    if run_params.get('CLASSIFIER_INPUT_RSMO'):
+        # The user chose a classifier explicitly
+        return run_params, None, False
+
+    cache_key = model_cache_key(run_params)
+    cached_path = find_cached_model(cache_key)
+    if cached_path:
+        feedback.pushInfo(f"Using cached classifier {cached_path}; skipping training")
+        run_params['CLASSIFIER_INPUT_RSMO'] = cached_path
+        return run_params, cache_key, True
+
+    run_params['SAVE_SIGNATURE'] = True
+    return run_params, cache_key, False
+
+
+def apply_band_stack(job_id, final_params, feedback):
+    """
+    Points a run at the cached band stack of its scene, building the stack
+    the first time this band list is seen. Falls back to the original band
+    files when the stack is too large, being built elsewhere, or fails.
+    """
+    band_paths = final_params.get('BAND_INPUT_LAYERS') or []
+    if len(band_paths) < 2:
+        return final_params
+
+    cache_key = band_stack_key(final_params)
+    wrappers = find_band_stack(cache_key)
+    if wrappers:
+        feedback.pushInfo(f"Reading bands from cached band stack {cache_key[:12]}")
+    else:
+        try:
+            mismatch = band_stack_mismatch(band_paths)
+            stack_bytes = estimate_stack_bytes(band_paths)
+        except RuntimeError as e:
+            feedback.pushWarning(f"Could not read the band headers, skipping the band stack cache: {e}")
+            return final_params
+        if mismatch:
+            feedback.pushInfo(f"{mismatch}; reading the band files directly")
+            return final_params
+        if stack_bytes > BAND_STACK_MAX_BYTES:
+            feedback.pushInfo("Band stack would exceed the cache size; reading the band files directly")
+            return final_params
+        if not claim_band_stack_build(cache_key, band_paths):
+            feedback.pushInfo("Band stack is being built by another worker; reading the band files directly")
+            return final_params
+
+        stack_folder = BAND_STACK_DIR / cache_key
+        feedback.setProgressText(f"Building band stack from {len(band_paths)} band files")
+        try:
+            with job_phase(job_id, 'band_stack'):
+                wrappers = build_band_stack(band_paths, stack_folder)
+        except Exception as e:
+            abandon_band_stack_build(cache_key, stack_folder)
+            feedback.pushWarning(f"Could not build the band stack, reading the band files directly: {e}")
+            return final_params
+        store_band_stack(cache_key, stack_folder, wrappers)
+        evict_band_stacks(keep=cache_key)
+
+    run_params = dict(final_params)
+    run_params['BAND_INPUT_LAYERS'] = wrappers
+    return run_params
+
+
+def process_job(job):
+    """Runs one claimed job and stores its outcome."""
+    job_id = job['id']
+    print(f"Starting job {job_id}")
+    feedback = JobFeedback(job_id)
+    final_params = json.loads(job['params'])
+    cache_key, cache_hit = None, False
+    try:
+        if BAND_STACK_CACHE and job['kind'] != 'mosaic':
+            final_params = apply_band_stack(job_id, final_params, feedback)
+        if job['kind'] == 'tile':
+            record_job_training(job_id, False)
+            with job_phase(job_id, 'classification'):
+                results, output_folder = classify_tile(job, final_params, feedback)
+        elif job['kind'] == 'mosaic':
+            with job_phase(job_id, 'mosaic'):
+                results, output_folder = mosaic_tiled_job(job, feedback)
+        else:
+            if job_options(job)['USE_MODEL_CACHE']:
+                final_params, cache_key, cache_hit = apply_model_cache(final_params, feedback)
+            record_job_training(job_id, not final_params.get('CLASSIFIER_INPUT_RSMO'))
+            with job_phase(job_id, 'classification'):
+                results, output_folder = execute_classification(final_params, feedback)
+    except Exception as e:
+        feedback.sync(force=True)
+        if feedback.isCanceled():
+            print(f"Job {job_id} cancelled")
+            finish_job(job_id, 'cancelled', "Cancelled while running")
+        else:
+            print(f"Error during processing of job {job_id}: {e}")
+            finish_job(job_id, 'failed', str(e))
+            if job['kind'] == 'tile':
+                cancel_queued_tiles(job['parent_id'], "Another tile of this run failed")
+        return
+    feedback.sync(force=True)
+
+    if job['kind'] == 'tile':
+        # Tiles are intermediate outputs; the mosaic job publishes the run
+        finish_job(job_id, 'succeeded', "Tile classified", results)
+        print(f"Tile job {job_id} succeeded")
+        return
+
+    record_result(job_id, output_folder)
+    if output_folder:
+        try:
+            record_job_accuracy(job_id, extract_overall_accuracy(output_folder))
+        except OSError as e:
+            # e.g. the report is locked by a sync client; the run itself succeeded
+            print(f"Could not read the accuracy report of job {job_id}: {e}")
+
+    detail = ""
+    if job['kind'] == 'mosaic':
+        detail = f" Mosaicked {results['TILES']} tiles."
+    elif cache_hit:
+        detail = " Used cached classifier."
+    elif cache_key and output_folder:
+        try:
+            if store_trained_model(cache_key, output_folder, final_params, job_id):
+                detail = " Trained classifier cached."
+        except Exception as e:
+            print(f"Could not cache the classifier of job {job_id}: {e}")
+
+    if output_folder and CONVERT_OUTPUTS_TO_COG:
+        with job_phase(job_id, 'cog'):
+            converted = convert_outputs_to_cog(output_folder, feedback)
+        feedback.sync(force=True)
+        if converted:
+            detail += f" Converted {converted} raster(s) to COG."
+
+    # 3. Upload the entire folder to S3
+    if output_folder is None:
+        update_job_upload(job_id, 'skipped')
+        finish_job(job_id, 'succeeded', f"Classification complete.{detail} Skipped S3 (Output path invalid)", results)
+    elif S3_UPLOAD_IN_BACKGROUND:
+        update_job_upload(job_id, 'queued')
+        finish_job(job_id, 'succeeded', f"Classification complete.{detail} Uploading to S3 in the background", results)
+        UPLOAD_EXECUTOR.submit(upload_job_outputs, job_id, output_folder)
+    else:
+        feedback.setProgressText("Uploading outputs to S3")
+        feedback.sync(force=True)
+        try:
+            summary = upload_job_outputs(job_id, output_folder)
+            upload_message = describe_upload(summary)
+        except Exception as e:
+            upload_message = f"Upload to S3 failed: {e}"
+        finish_job(job_id, 'succeeded', f"Classification complete.{detail} {upload_message}", results)
+    print(f"Job {job_id} succeeded")
+
+
+def run_worker_loop(stop_event):
+    """
+    Drains the shared job queue one job at a time. This must run on the
+    thread that created the QgsApplication, since QGIS is not thread safe.
+    """
+    while not stop_event.is_set():
+        job = claim_next_job()
+        if job is None:
+            stop_event.wait(WORKER_POLL_SECONDS)
+            continue
+        try:
+            process_job(job)
+        except Exception as e:
+            # A failure after the classification step (recording results,
+            # COG conversion, upload) fails this job, not the worker
+            print(f"Error after processing job {job['id']}: {e}")
+            try:
+                fail_unfinished_job(job['id'], f"Post-processing failed: {e}")
+            except sqlite3.Error as db_error:
+                print(f"Could not mark job {job['id']} as failed: {db_error}")
+
+
+# --- 5. FLASK ROUTES ---
+def split_server_options(user_params):
+    """
+    Separates server options from algorithm parameters. Raises ValueError
+    when an option has the wrong type.
+    """
+    options = dict(SERVER_OPTIONS)
+    algorithm_params = {}
+    for key, value in user_params.items():
+        if key in SERVER_OPTIONS:
+            options[key] = value
+        else:
+            algorithm_params[key] = value
+
+    for key in ('FORCE_RERUN', 'USE_MODEL_CACHE'):
+        if not isinstance(options[key], bool):
+            raise ValueError(f"{key} must be true or false")
+    tile_size = options['TILE_SIZE']
+    if tile_size is None:
+        tile_size = 0
+    if isinstance(tile_size, bool) or not isinstance(tile_size, int) or tile_size < 0:
+        raise ValueError("TILE_SIZE must be a whole number of pixels")
+    options['TILE_SIZE'] = tile_size
+    return algorithm_params, options
+
+
+def merge_params(user_params):
+    """Merge defaults with user params"""
+    final_params = DEFAULT_PARAMS.copy()
+    final_params.update(user_params)
+    return final_params
+
+
+def preflight_request(final_params, options):
+    """
+    Checks a request from file headers only, before anything is queued: input
+    files exist and the bands share CRS, resolution and extent. Then estimates
+    memory and runtime and decides whether the run is tiled. Returns a report
+    whose "errors" are empty when the request can run.
+    """
+    errors, warnings = [], []
+    report = {"ok": False, "errors": errors, "warnings": warnings,
+              "scene": None, "estimate": None, "execution": None}
+
+    for key in ('TRAINING_INPUT_SCPX', 'TESTING_INPUT_SCPX', 'CLASSIFIER_INPUT_RSMO'):
+        path = final_params.get(key)
+        if path and not os.path.isfile(path):
+            errors.append(f"{key} does not exist: {path}")
+    if not final_params.get('TRAINING_INPUT_SCPX') and not final_params.get('CLASSIFIER_INPUT_RSMO'):
+        errors.append("Provide TRAINING_INPUT_SCPX or CLASSIFIER_INPUT_RSMO")
+
+    band_paths = final_params.get('BAND_INPUT_LAYERS') or []
+    if not band_paths:
+        errors.append("BAND_INPUT_LAYERS is empty")
+    grids = {}
+    for path in band_paths:
+        if not os.path.isfile(path):
+            errors.append(f"Band does not exist: {path}")
+            continue
+        if gdal is None:
+            continue
+        try:
+            grids[path] = read_raster_grid(path)
+        except RuntimeError as e:
+            errors.append(f"Band is not a readable raster: {path} ({e})")
+    if grids:
+        reference_path, reference = next(iter(grids.items()))
+        for path, grid in grids.items():
+            problem = describe_misalignment(path, grid, reference_path, reference)
+            if problem:
+                errors.append(problem)
+        report["scene"] = {
+            "width": reference['width'],
+            "height": reference['height'],
+            "pixels": reference['width'] * reference['height'],
+            "bands": len(band_paths),
+        }
+    if errors:
+        return report
+    if gdal is None:
+        warnings.append("GDAL is not available, so band alignment and cost were not checked")
+        report["ok"] = True
+        report["execution"] = {"mode": "single", "tile_size": int(options['TILE_SIZE'] or 0), "tiles": None}
+        return report
+
+    pixels, bands = report["scene"]["pixels"], len(band_paths)
+    memory_mb = pixels * bands * BYTES_PER_BAND_PIXEL / 1024 ** 2
+    has_classifier = bool(final_params.get('CLASSIFIER_INPUT_RSMO') or (
+        options['USE_MODEL_CACHE']
+        and find_cached_model(model_cache_key(final_params), record_hit=False)
+    ))
+    runtime, history = estimate_runtime(final_params.get('ML_MODEL'), pixels, trains=not has_classifier)
+
+    tile_size = int(options['TILE_SIZE'] or 0)
+    if not tile_size and memory_mb > MAX_JOB_MEMORY_MB:
+        if has_classifier:
+            # Largest tile, in steps of MIN_TILE_SIZE, whose working set fits the budget
+            fitting = math.sqrt(MAX_JOB_MEMORY_MB * 1024 ** 2 / (bands * BYTES_PER_BAND_PIXEL))
+            tile_size = max(MIN_TILE_SIZE, int(fitting // MIN_TILE_SIZE) * MIN_TILE_SIZE)
+            warnings.append(
+                f"Estimated {memory_mb:.0f} MB exceeds the {MAX_JOB_MEMORY_MB} MB per-job budget; "
+                f"running in {tile_size} px tiles"
+            )
+        else:
+            warnings.append(
+                f"Estimated {memory_mb:.0f} MB exceeds the {MAX_JOB_MEMORY_MB} MB per-job budget, but "
+                "there is no trained classifier to tile with; it will run as one job"
+            )
+
+    execution = {"mode": "single", "tile_size": 0, "tiles": 1}
+    if tile_size:
+        tiles = math.ceil(reference['width'] / tile_size) * math.ceil(reference['height'] / tile_size)
+        execution = {"mode": "tiled" if tiles > 1 else "single", "tile_size": tile_size, "tiles": tiles}
+        memory_mb = min(tile_size, reference['width']) * min(tile_size, reference['height']) \
+            * bands * BYTES_PER_BAND_PIXEL / 1024 ** 2
+        if runtime is not None:
+            runtime = round(runtime / min(tiles, QGIS_WORKER_COUNT), 1)
+    if runtime is None:
+        kind = "applying a trained classifier" if has_classifier else "training a classifier"
+        warnings.append(f"No finished runs of this algorithm {kind} yet, so the runtime cannot be estimated")
+
+    report["ok"] = True
+    report["execution"] = execution
+    report["estimate"] = {
+        "memory_mb_per_job": round(memory_mb, 1),
+        "runtime_seconds": runtime,
+        "based_on_runs": history,
+    }
+    return report
+
+
+def plan_tiled_run(final_params, options):
+    """
+    Returns the tiles of a tiled request and the parameters every tile runs
+    with, or (None, None) when the scene is classified as a single job.
+    Raises ValueError when the request cannot be tiled.
+    """
+    tile_size = int(options['TILE_SIZE'] or 0)
+    if tile_size <= 0:
+        return None, None
+    if tile_size < MIN_TILE_SIZE:
+        raise ValueError(f"TILE_SIZE must be 0 or at least {MIN_TILE_SIZE} pixels")
+    if gdal is None:
+        raise ValueError("Tiled runs need GDAL")
+
+    # Every tile must apply the same trained classifier, so it has to exist up front
+    model_path = final_params.get('CLASSIFIER_INPUT_RSMO')
+    if not model_path and options['USE_MODEL_CACHE']:
+        model_path = find_cached_model(model_cache_key(final_params))
+    if not model_path:
+        raise ValueError(
+            "Tiled runs apply one trained classifier to every tile. Pass CLASSIFIER_INPUT_RSMO, "
+            "or run the request once without tiling so its classifier is cached."
+        )
+
+    try:
+        tiles = plan_tiles(final_params['BAND_INPUT_LAYERS'], tile_size, TILE_OVERLAP_PIXELS)
+    except RuntimeError as e:
+        raise ValueError(f"Could not read the input bands: {e}") from e
+    if len(tiles) == 1:
+        return None, None
+
+    tile_params = dict(final_params)
+    tile_params.update({
+        'CLASSIFIER_INPUT_RSMO': model_path,
+        'SAVE_SIGNATURE': False,
+        # Accuracy against the testing ROIs means nothing for a single tile
+        'TESTING_INPUT_SCPX': '',
+    })
+    return tiles, tile_params
+
+
+@app.route('/jobs', methods=['POST'])
 @app.route('/ml-request', methods=['POST'])
 def ml_request():
-    global LOADED_ALG
-    if not LOADED_ALG:
-        return jsonify({"error": "QGIS Algorithm not loaded"}), 500
+    """Queues a classification and returns straight away with its job id."""
+    user_params = request.get_json(silent=True) or {}
+    if not isinstance(user_params, dict):
+        return jsonify({"status": "error", "message": "Request body must be a JSON object"}), 400
 
+    print(f"Received request. Overriding {len(user_params)} parameters.")
     try:
-        user_params = request.get_json() or {}
-        print(f"Received request. Overriding {len(user_params)} parameters.")
-
-        # Merge defaults with user params
-        final_params = DEFAULT_PARAMS.copy()
-        final_params.update(user_params)
-
-        # --- DIRECT EXECUTION ---
-        context = QgsProcessingContext()
-        feedback = QgsProcessingFeedback()
-
-        # Run the algorithm
-        results, success = LOADED_ALG.run(final_params, context, feedback)
-
-        if success:
-            # 1. Get the path to the output raster (e.g., .../RandomForest-Date/classification.tif)
-            raster_output = results.get('RASTER_OUTPUT')
-            
-            # 2. Derive the parent folder path (e.g., .../RandomForest-Date)
-            # We do this because the script creates a folder, puts files in it, and returns the file path.
-            if raster_output and os.path.exists(raster_output):
-                output_folder = os.path.dirname(raster_output)
-                
-                # 3. Upload the entire folder to S3
-                upload_folder_to_s3(output_folder, S3_BUCKET_NAME)
-                
-                upload_status = "Uploaded to S3"
-            else:
-                upload_status = "Skipped S3 (Output path invalid)"
+        algorithm_params, options = split_server_options(user_params)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    final_params = merge_params(algorithm_params)
+    report = preflight_request(final_params, options)
+    if not report["ok"]:
+        return jsonify({
+            "status": "error",
+            "message": f"Preflight failed: {'; '.join(report['errors'])}",
+            "preflight": report
+        }), 400
+    options['TILE_SIZE'] = report["execution"]["tile_size"]
+    try:
+        tiles, tile_params = plan_tiled_run(final_params, options)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e), "preflight": report}), 400
+    job_id, reused = submit_job(
+        final_params, options, tiles, tile_params, (report["scene"] or {}).get("pixels")
+    )
 
+    if reused:
+        print(f"Identical request matched {reused} job {job_id}")
+    job = job_to_dict(get_job(job_id))
+    job["deduplicated"] = reused
+    job["status_url"] = f"/jobs/{job_id}"
+    job["preflight"] = report
+    return jsonify(job), 200 if reused == 'completed' else 202
+
+
+@app.route('/jobs/preflight', methods=['POST'])
+def preflight():
+    """Dry run: validates a request and estimates its cost without queuing it."""
+    user_params = request.get_json(silent=True) or {}
+    if not isinstance(user_params, dict):
+        return jsonify({"status": "error", "message": "Request body must be a JSON object"}), 400
+    try:
+        algorithm_params, options = split_server_options(user_params)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify(preflight_request(merge_params(algorithm_params), options))
+
+
+def sweep_value_fits(key, value):
+    """
+    Checks a swept value has the shape of the parameter's default: a list of
+    scalars for list parameters such as BAND_INPUT_LAYERS, a scalar otherwise.
+    """
+    scalar = (str, int, float, bool, type(None))
+    if isinstance(DEFAULT_PARAMS[key], list):
+        return isinstance(value, list) and all(isinstance(item, scalar) for item in value)
+    return isinstance(value, scalar)
+
+
+def expand_sweep(grid, variants, base_ml_model):
+    """
+    Expands explicit variants and a parameter grid into a list of overrides.
+    Hyperparameters that do not apply to a variant's ML_MODEL are dropped,
+    so sweeping RF_TREES next to an SVM does not queue identical SVM runs.
+    """
+    keys = list(grid)
+    combos = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+    expanded, seen = [], set()
+    for variant in variants or [{}]:
+        for combo in combos:
+            overrides = {**variant, **combo}
+            own = MODEL_HYPERPARAMS.get(overrides.get('ML_MODEL', base_ml_model), ())
+            foreign = {k for params in MODEL_HYPERPARAMS.values() for k in params} - set(own)
+            overrides = {k: v for k, v in overrides.items() if k not in foreign}
+
+            marker = json.dumps(overrides, sort_keys=True, default=str)
+            if marker not in seen:
+                seen.add(marker)
+                expanded.append(overrides)
+    return expanded
+
+
+@app.route('/batches', methods=['POST'])
+def submit_batch():
+    """
+    Queues one job per variant of a base parameter set. The body holds
+    "base" (parameter overrides, plus server options), "grid" (parameter ->
+    list of values) and/or "variants" (list of override dicts).
+    """
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        return jsonify({"status": "error", "message": "Request body must be a JSON object"}), 400
+    grid = body.get('grid') or {}
+    variants = body.get('variants') or []
+    base = body.get('base') or {}
+    if not isinstance(grid, dict) or not isinstance(variants, list) or not isinstance(base, dict):
+        return jsonify({"status": "error", "message": "base and grid must be objects and variants a list"}), 400
+    if not grid and not variants:
+        return jsonify({"status": "error", "message": "Provide a grid or a list of variants"}), 400
+    if not all(isinstance(variant, dict) for variant in variants):
+        return jsonify({"status": "error", "message": "Every variant must be an object"}), 400
+
+    swept = set(grid) | {key for variant in variants for key in variant}
+    unknown = sorted(swept - set(DEFAULT_PARAMS))
+    if unknown:
+        return jsonify({"status": "error", "message": f"Unknown parameters: {unknown}"}), 400
+    if any(not isinstance(values, list) or not values for values in grid.values()):
+        return jsonify({"status": "error", "message": "Every grid entry must be a non-empty list"}), 400
+    swept_values = [(key, value) for key, values in grid.items() for value in values]
+    swept_values += [item for variant in variants for item in variant.items()]
+    for key, value in swept_values:
+        if not sweep_value_fits(key, value):
+            return jsonify({"status": "error", "message": f"Invalid value for {key}: {json.dumps(value)}"}), 400
+
+    try:
+        base_params, options = split_server_options(base)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    overrides_list = expand_sweep(grid, variants, merge_params(base_params)['ML_MODEL'])
+    if len(overrides_list) > MAX_BATCH_VARIANTS:
+        return jsonify({
+            "status": "error",
+            "message": f"Sweep expands to {len(overrides_list)} runs; the limit is {MAX_BATCH_VARIANTS}"
+        }), 400
+
+    runs = []
+    for overrides in overrides_list:
+        final_params = merge_params({**base_params, **overrides})
+        run_options = dict(options)
+        report = preflight_request(final_params, run_options)
+        if not report["ok"]:
             return jsonify({
-                "status": "success",
-                "message": f"Classification complete. {upload_status}",
-                "result": results
-            })
-        else:
-            return jsonify({
-                "status": "failure",
-                "message": "Algorithm reported failure"
-            }), 500
+                "status": "error",
+                "message": f"Preflight failed for {overrides}: {'; '.join(report['errors'])}",
+                "preflight": report
+            }), 400
+        run_options['TILE_SIZE'] = report["execution"]["tile_size"]
+        try:
+            tiles, tile_params = plan_tiled_run(final_params, run_options)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": f"{overrides}: {e}"}), 400
+        pixels = (report["scene"] or {}).get("pixels")
+        runs.append((overrides, final_params, run_options, tiles, tile_params, pixels))
+
+    batch_id = uuid.uuid4().hex
+    rows = []
+    for position, (overrides, final_params, run_options, tiles, tile_params, pixels) in enumerate(runs):
+        job_id, _ = submit_job(final_params, run_options, tiles, tile_params, pixels)
+        rows.append((batch_id, position, job_id, json.dumps(overrides)))
+
+    with job_db() as conn:
+        conn.execute(
+            "INSERT INTO batches (id, base_params, created_at) VALUES (?, ?, ?)",
+            (batch_id, json.dumps(base_params), time.time())
+        )
+        conn.executemany(
+            "INSERT INTO batch_jobs (batch_id, position, job_id, variant) VALUES (?, ?, ?, ?)", rows
+        )
+    print(f"Queued batch {batch_id} with {len(rows)} variant(s)")
+
+    return jsonify({
+        "batch_id": batch_id,
+        "variants": len(rows),
+        "status_url": f"/batches/{batch_id}"
+    }), 202
+
+
+@app.route('/batches/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    """
+    Summary table of a batch: one row per variant with status, runtime and
+    accuracy. The runtime is the classification phase only (summed over the
+    tiles of a tiled run), so variants compare on the algorithm rather than
+    on upload speed.
+    """
+    with job_db() as conn:
+        rows = conn.execute(
+            "SELECT b.position, b.variant, j.* FROM batch_jobs b JOIN jobs j ON j.id = b.job_id "
+            "WHERE b.batch_id = ? ORDER BY b.position",
+            (batch_id,)
+        ).fetchall()
+        runtimes = dict(conn.execute(
+            "SELECT COALESCE(j.parent_id, j.id) AS run_id, SUM(p.seconds) FROM job_phases p "
+            "JOIN jobs j ON j.id = p.job_id "
+            "JOIN batch_jobs b ON b.job_id = COALESCE(j.parent_id, j.id) "
+            "WHERE b.batch_id = ? AND p.phase = 'classification' AND p.outcome = 'succeeded' "
+            "GROUP BY run_id",
+            (batch_id,)
+        ).fetchall())
+    if not rows:
+        return jsonify({"status": "error", "message": "Unknown batch id"}), 404
+
+    summary = []
+    for row in rows:
+        runtime = runtimes.get(row['id'])
+        if runtime is not None:
+            runtime = round(runtime, 1)
+        summary.append({
+            "position": row['position'],
+            "variant": json.loads(row['variant']),
+            "job_id": row['id'],
+            "status": row['status'],
+            "runtime_seconds": runtime,
+            "accuracy": row['accuracy'],
+            "message": row['message'],
+        })
+
+    counts = {}
+    for item in summary:
+        counts[item['status']] = counts.get(item['status'], 0) + 1
+    return jsonify({
+        "batch_id": batch_id,
+        "done": all(item['status'] in TERMINAL_STATUSES for item in summary),
+        "counts": counts,
+        "variants": summary,
+    })
+
+
+@app.route('/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    with job_db() as conn:
+        job_ids = [row['job_id'] for row in conn.execute(
+            "SELECT job_id FROM batch_jobs WHERE batch_id = ?", (batch_id,)
+        )]
+    if not job_ids:
+        return jsonify({"status": "error", "message": "Unknown batch id"}), 404
+    for job_id in job_ids:
+        request_job_cancel(job_id)
+    return batch_status(batch_id)
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """Lists the most recent jobs, optionally filtered by ?status=."""
+    status = request.args.get('status')
+    limit = request.args.get('limit', 50, type=int)
+    query = "SELECT * FROM jobs"
+    args = []
+    if status:
+        query += " WHERE status = ?"
+        args.append(status)
+    query += " ORDER BY created_at DESC LIMIT ?"
+    args.append(limit)
+
+    with job_db() as conn:
+        rows = conn.execute(query, args).fetchall()
+    return jsonify({"jobs": [job_to_dict(row) for row in rows]})
+
+
+@app.route('/workers', methods=['GET'])
+def list_workers():
+    """Reports the state of each pool process."""
+    with job_db() as conn:
+        running = {
+            row['worker_pid']: row['id']
+            for row in conn.execute("SELECT id, worker_pid FROM jobs WHERE status = 'running'")
+        }
+    return jsonify({"workers": [
+        {
+            "slot": slot,
+            "pid": proc.pid,
+            "alive": proc.is_alive(),
+            "job_id": running.get(proc.pid),
+            "crashes": WORKER_STATE[slot]['crashes'],
+            "gave_up": WORKER_STATE[slot]['gave_up'],
+        }
+        for slot, proc in sorted(WORKERS.items())
+    ]})
+
+
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Lists the cached trained classifiers."""
+    with job_db() as conn:
+        rows = conn.execute("SELECT * FROM models ORDER BY last_used_at DESC").fetchall()
+    return jsonify({"models": [dict(row) for row in rows]})
+
+
+@app.route('/jobs/history', methods=['GET'])
+def job_history():
+    """
+    Finished jobs with their timings, for capacity planning: queue wait, wall
+    time per phase, pixel count, upload volume, versions, parameters and outcome.
+    Filter with ?algorithm=<ML_MODEL index>, ?since=<unix time> and ?limit=.
+    """
+    limit = request.args.get('limit', 200, type=int)
+    since = request.args.get('since', 0, type=float)
+    algorithm = request.args.get('algorithm', type=int)
+
+    query = "SELECT * FROM jobs WHERE status IN ('succeeded', 'failed', 'cancelled') AND finished_at >= ?"
+    args = [since]
+    if algorithm is not None:
+        query += " AND json_extract(params, '$.ML_MODEL') = ?"
+        args.append(algorithm)
+    query += " ORDER BY finished_at DESC LIMIT ?"
+    args.append(limit)
+
+    with job_db() as conn:
+        rows = conn.execute(query, args).fetchall()
+        phases = {}
+        for phase in conn.execute(
+            f"SELECT job_id, phase, seconds, outcome FROM job_phases "
+            f"WHERE job_id IN ({','.join('?' * len(rows))})",
+            [row['id'] for row in rows]
+        ):
+            phases.setdefault(phase['job_id'], {})[phase['phase']] = phase['seconds']
+
+    history = []
+    for row in rows:
+        params = json.loads(row['params'])
+        upload = json.loads(row['upload_summary']) if row['upload_summary'] else {}
+        history.append({
+            "job_id": row['id'],
+            "kind": row['kind'],
+            "parent_id": row['parent_id'],
+            "status": row['status'],
+            "message": row['message'],
+            "ml_model": params.get('ML_MODEL'),
+            "created_at": row['created_at'],
+            "queue_wait_seconds": round(row['started_at'] - row['created_at'], 3) if row['started_at'] else None,
+            "total_seconds": round(row['finished_at'] - row['started_at'], 3) if row['started_at'] else None,
+            "phases": phases.get(row['id'], {}),
+            "pixels": row['pixels'],
+            "bands": len(params.get('BAND_INPUT_LAYERS') or []),
+            "upload_bytes": upload.get('bytes_uploaded'),
+            "accuracy": row['accuracy'],
+            "qgis_version": row['qgis_version'],
+            "script_version": row['script_version'],
+            "params": params,
+        })
+    return jsonify({"jobs": history})
+
+
+@app.route('/band-stacks', methods=['GET'])
+def list_band_stacks():
+    """Lists the cached band stacks."""
+    with job_db() as conn:
+        rows = conn.execute("SELECT * FROM band_stacks ORDER BY last_used_at DESC").fetchall()
+    stacks = []
+    for row in rows:
+        stack = dict(row)
+        stack['band_paths'] = json.loads(row['band_paths'])
+        stack['wrappers'] = json.loads(row['wrappers']) if row['wrappers'] else None
+        stacks.append(stack)
+    return jsonify({"band_stacks": stacks})
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    row = get_job(job_id)
+    if row is None:
+        return jsonify({"status": "error", "message": "Unknown job id"}), 404
+    job = job_to_dict(row)
+    job["phases"] = get_job_phases(job_id)
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if get_job(job_id) is None:
+        return jsonify({"status": "error", "message": "Unknown job id"}), 404
+    request_job_cancel(job_id)
+    return jsonify(job_to_dict(get_job(job_id)))
+
+
+@app.route('/jobs/<job_id>/log', methods=['GET'])
+def job_log(job_id):
+    """
+    Long-poll for log lines after ?since=<line id>. Waits up to ?wait= seconds
+    for new lines or a status change before answering.
+    """
+    since = request.args.get('since', 0, type=int)
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_MAX_SECONDS)
+
+    row = get_job(job_id)
+    if row is None:
+        return jsonify({"status": "error", "message": "Unknown job id"}), 404
+
+    deadline = time.time() + wait
+    lines = get_job_logs(job_id, since)
+    while not lines and row['status'] not in TERMINAL_STATUSES and time.time() < deadline:
+        time.sleep(EVENT_POLL_SECONDS)
+        lines = get_job_logs(job_id, since)
+        row = get_job(job_id)
+
+    return jsonify({
+        "job": job_to_dict(row),
+        "lines": lines,
+        "last_id": lines[-1]['id'] if lines else since,
+    })
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-    except Exception as e:
-        print(f"Error during processing: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
 
-# --- 4. SETUP FUNCTION ---
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events stream of status changes and log lines until the job ends."""
+    if get_job(job_id) is None:
+        return jsonify({"status": "error", "message": "Unknown job id"}), 404
+
+    def generate():
+        last_line_id = request.args.get('since', 0, type=int)
+        last_state = None
+        last_sent = time.time()
+        while True:
+            for line in get_job_logs(job_id, last_line_id):
+                last_line_id = line['id']
+                yield format_event('log', line)
+                last_sent = time.time()
+
+            job = job_to_dict(get_job(job_id))
+            state = (job['status'], job['progress'], job['step'], job.get('queue_position'))
+            if state != last_state:
+                last_state = state
+                yield format_event('status', job)
+                last_sent = time.time()
+
+            if job['status'] in TERMINAL_STATUSES:
+                return
+            if time.time() - last_sent > EVENT_HEARTBEAT_SECONDS:
+                # Comment line keeps proxies and client read timeouts from closing the stream
+                yield ": heartbeat\n\n"
+                last_sent = time.time()
+            time.sleep(EVENT_POLL_SECONDS)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels.items()
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def add_metric(lines, name, metric_type, help_text, samples):
+    """Appends one metric family in Prometheus text format; samples are (labels, value) pairs."""
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+
+def add_histogram(lines, name, help_text, totals):
+    """
+    Appends a histogram from its running totals (see histogram_observation).
+    A bucket no observation fell into has no row yet and is written as 0.
+    """
+    series = {}
+    for suffix in ('count', 'sum', 'bucket'):
+        for labels, value in totals.get(f"{name}_{suffix}", []):
+            le = labels.pop('le', None)
+            entry = series.setdefault(tuple(labels.items()), {'count': 0, 'sum': 0, 'buckets': {}})
+            if suffix == 'bucket':
+                entry['buckets'][le] = value
+            else:
+                entry[suffix] = value
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for label_items, entry in sorted(series.items()):
+        labels = dict(label_items)
+        for bound in DURATION_BUCKETS:
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {entry['buckets'].get(str(bound), 0)}")
+        lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {entry['count']}")
+    for label_items, entry in sorted(series.items()):
+        lines.append(f"{name}_sum{format_labels(dict(label_items))} {round(entry['sum'], 3)}")
+        lines.append(f"{name}_count{format_labels(dict(label_items))} {entry['count']}")
+
+
+def algorithm_label(ml_model):
+    return ALGORITHM_NAMES.get(ml_model, str(ml_model))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus metrics. Counters and histograms come from the running totals
+    in metric_totals, so a scrape costs the same however long the history is.
+    """
+    with job_db() as conn:
+        current = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        totals = {}
+        for row in conn.execute("SELECT name, labels, value FROM metric_totals"):
+            value = int(row['value']) if float(row['value']).is_integer() else round(row['value'], 3)
+            totals.setdefault(row['name'], []).append((json.loads(row['labels']), value))
+        models = conn.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM models").fetchone()
+        stacks = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(hits), 0) FROM band_stacks "
+            "WHERE status = 'ready'"
+        ).fetchone()
+
+    def counter_samples(name):
+        """Samples of a counter, with the ML_MODEL index the trigger stores shown as an algorithm name."""
+        samples = []
+        for labels, value in totals.get(name, []):
+            if 'ml_model' in labels:
+                labels = {'algorithm': algorithm_label(labels.pop('ml_model')), **labels}
+            samples.append((labels, value))
+        return sorted(samples, key=lambda sample: sorted(sample[0].items()))
+
+    lines = []
+    add_metric(lines, 'qgis_ml_jobs', 'gauge', "Jobs in the job store by current status.",
+               [({'status': status}, count) for status, count in sorted(current.items())])
+    add_metric(lines, 'qgis_ml_jobs_finished_total', 'counter', "Finished jobs by algorithm, kind and outcome.",
+               counter_samples('qgis_ml_jobs_finished_total'))
+    add_histogram(lines, 'qgis_ml_queue_wait_seconds', "Time from submission until a worker started the job.", totals)
+    add_histogram(lines, 'qgis_ml_phase_seconds', "Wall time of each job phase.", totals)
+    add_metric(lines, 'qgis_ml_pixels_classified_total', 'counter', "Pixels of successfully classified scenes and tiles.",
+               counter_samples('qgis_ml_pixels_classified_total'))
+    for name, help_text in (
+        ('qgis_ml_upload_bytes_total', "Bytes uploaded to S3."),
+        ('qgis_ml_upload_seconds_total', "Time spent uploading to S3."),
+        ('qgis_ml_upload_files_total', "Files uploaded to S3."),
+    ):
+        add_metric(lines, name, 'counter', help_text, counter_samples(name) or [({}, 0)])
+    add_metric(lines, 'qgis_ml_workers', 'gauge', "QGIS worker processes by state.", [
+        ({'state': 'alive'}, sum(proc.is_alive() for proc in WORKERS.values())),
+        ({'state': 'dead'}, sum(not proc.is_alive() for proc in WORKERS.values())),
+    ])
+    add_metric(lines, 'qgis_ml_cached_models', 'gauge', "Trained classifiers in the model cache.", [({}, models[0])])
+    add_metric(lines, 'qgis_ml_model_cache_hits_total', 'counter', "Runs that reused a cached classifier.",
+               [({}, models[1])])
+    add_metric(lines, 'qgis_ml_band_stacks', 'gauge', "Band stacks in the band stack cache.", [({}, stacks[0])])
+    add_metric(lines, 'qgis_ml_band_stack_bytes', 'gauge', "Disk used by the band stack cache.", [({}, stacks[1])])
+    add_metric(lines, 'qgis_ml_band_stack_hits_total', 'counter', "Runs that read a cached band stack.",
+               [({}, stacks[2])])
+
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+
+# --- 6. SETUP FUNCTION ---
 def setup_qgis_and_algorithm():
     """Initializes QGIS and loads the algorithm instance."""
     qgs = QgsApplication([], False)
     qgs.initQgis()
 
+    if STANDIN_MODE:
+        import standin
+        alg_instance = standin.Classification()
+        alg_instance.initAlgorithm()
+        print(f"Stand-in algorithm '{alg_instance.name()}' loaded.")
+        return qgs, alg_instance
+
     import processing
     from processing.core.Processing import Processing
     Processing.initialize()
 
     # Load Custom Script Manually
-    script_path = r'C:\Users\User\AppData\Roaming\QGIS\QGIS3\profiles\default\processing\scripts\scp-classification.py'
-    
-    spec = importlib.util.spec_from_file_location("scp_classification", script_path)
+    spec = importlib.util.spec_from_file_location("scp_classification", SCP_SCRIPT_PATH)
     module = importlib.util.module_from_spec(spec)
     sys.modules["scp_classification"] = module
     spec.loader.exec_module(module)
@@ -179,18 +2397,109 @@ def setup_qgis_and_algorithm():
     
     return qgs, alg_instance
 
-# --- 5. MAIN ENTRY POINT ---
-if __name__ == '__main__':
-    multiprocessing.freeze_support()
+# --- 7. WORKER POOL ---
+# Pool processes by slot number, only populated in the Flask (parent) process
+WORKERS = {}
+# Restart bookkeeping by slot: start time, crashes in a row, restart due time
+WORKER_STATE = {}
+
+
+def worker_process_main(slot):
+    """Entry point of a pool process: starts QGIS once, then drains the shared queue."""
+    global LOADED_ALG, WORKER_SLOT, QGIS_VERSION, SCRIPT_VERSION
+    WORKER_SLOT = slot
 
-    print("Initializing QGIS Engine...")
+    print(f"[worker {slot}] Initializing QGIS Engine...")
     qgs_instance, alg_instance = setup_qgis_and_algorithm()
-    
-    # Set the global variable
     LOADED_ALG = alg_instance
+    QGIS_VERSION = Qgis.version()
+    SCRIPT_VERSION = file_md5(sys.modules[type(alg_instance).__module__].__file__)[:12]
 
-    print("Starting Flask Server on port 5000...")
-    # threaded=False is REQUIRED for QGIS stability
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=False)
+    stop_event = threading.Event()
+    try:
+        run_worker_loop(stop_event)
+    except KeyboardInterrupt:
+        stop_event.set()
+    finally:
+        qgs_instance.exitQgis()
+
+
+def start_worker(slot):
+    # Not a daemon process: SCP starts its own multiprocessing pools,
+    # which daemonic processes are not allowed to do.
+    proc = multiprocessing.Process(
+        target=worker_process_main, args=(slot,), name=f"qgis-worker-{slot}"
+    )
+    proc.start()
+    state = WORKER_STATE.setdefault(slot, {'crashes': 0, 'gave_up': False})
+    state.update(started_at=time.time(), restart_at=None)
+    print(f"Started QGIS worker {slot} (pid {proc.pid})")
+    return proc
+
+
+def supervise_workers(stop_event):
+    """
+    Restarts crashed workers with a growing delay and fails the job each one
+    was running. A slot whose worker keeps crashing (e.g. a bad
+    SCP_SCRIPT_PATH or a broken QGIS install) is eventually left empty.
+    """
+    while not stop_event.wait(SUPERVISOR_POLL_SECONDS):
+        now = time.time()
+        for slot, proc in list(WORKERS.items()):
+            state = WORKER_STATE[slot]
+            if proc.is_alive() or state['gave_up']:
+                continue
+            if state['restart_at'] is None:
+                try:
+                    fail_jobs_of_worker(proc.pid, f"QGIS worker crashed (exit code {proc.exitcode})")
+                except sqlite3.Error as e:
+                    print(f"Could not fail the job of QGIS worker {slot}: {e}")
+                if now - state['started_at'] >= WORKER_STABLE_SECONDS:
+                    state['crashes'] = 0
+                state['crashes'] += 1
+                if state['crashes'] > WORKER_MAX_RESTARTS:
+                    state['gave_up'] = True
+                    print(f"QGIS worker {slot} crashed {WORKER_MAX_RESTARTS + 1} times in a row. "
+                          f"Not restarting it; check the QGIS install and SCP_SCRIPT_PATH.")
+                    continue
+                delay = min(SUPERVISOR_POLL_SECONDS * 2 ** (state['crashes'] - 1),
+                            WORKER_RESTART_MAX_DELAY_SECONDS)
+                state['restart_at'] = now + delay
+                print(f"QGIS worker {slot} (pid {proc.pid}) exited with code {proc.exitcode}. "
+                      f"Restarting in {delay:.0f}s.")
+            if now >= state['restart_at']:
+                WORKERS[slot] = start_worker(slot)
 
-    qgs_instance.exitQgis()
\ No newline at end of file
+
+def stop_workers():
+    for proc in WORKERS.values():
+        proc.terminate()
+    for proc in WORKERS.values():
+        proc.join(timeout=10)
+
+
+# --- 8. MAIN ENTRY POINT ---
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    init_job_db()
+    clean_tile_work_dir()
+
+    print(f"Starting {QGIS_WORKER_COUNT} QGIS worker process(es)...")
+    for slot in range(QGIS_WORKER_COUNT):
+        WORKERS[slot] = start_worker(slot)
+
+    stop_event = threading.Event()
+    supervisor_thread = threading.Thread(target=supervise_workers, args=(stop_event,), daemon=True)
+    supervisor_thread.start()
+
+    # Turn SIGTERM into a normal exit so the workers are stopped below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print("Starting Flask Server on port 5000...")
+    # QGIS only runs inside the worker processes, so Flask can use threads
+    try:
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    finally:
+        stop_event.set()
+        stop_workers()
\ No newline at end of file
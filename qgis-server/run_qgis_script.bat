@@ -20,6 +20,19 @@ set AWS_SECRET_ACCESS_KEY=###
 set AWS_DEFAULT_REGION=###
 set MY_S3_BUCKET_NAME=###
 
+:: Optional: mark jobs done as soon as QGIS finishes and upload afterwards
+:: set S3_UPLOAD_IN_BACKGROUND=1
+:: set S3_UPLOAD_THREADS=8
+:: Optional: upload rasters exactly as SCP wrote them instead of as COGs
+:: set QGIS_ML_COG=0
+:: Optional: working memory budget per job; larger scenes are tiled when a classifier is available
+:: set QGIS_ML_MAX_JOB_MEMORY_MB=4096
+:: Optional: local cache of stacked input bands (set QGIS_ML_BAND_STACK_CACHE=0 to disable)
+:: set QGIS_ML_BAND_STACK_DIR=D:\qgis-ml\band-stack-cache
+:: set QGIS_ML_BAND_STACK_MAX_GB=20
+:: Optional: where scp-classification.py lives, if not in the default AppData plugin folder
+:: set SCP_SCRIPT_PATH=C:\path\to\scp-classification.py
+
 :: 4. RUN YOUR SCRIPT
 "%OSGEO4W_ROOT%\bin\python.exe" qgis-ml-server-flask.py
 
@@ -0,0 +1,203 @@
+"""
+Stand-ins for load testing qgis-ml-server-flask.py without QGIS or AWS.
+
+Set QGIS_ML_STANDIN=1 to run the server with the stand-in QGIS classes and
+Classification algorithm below, and S3_LOCAL_DIR=<folder> to upload into a
+local folder instead of S3. The algorithm sleeps, burns CPU and writes output
+files, configured with environment variables or per request parameters:
+
+    STANDIN_SLEEP_SECONDS   wall time of a run, spent sleeping (default 5)
+    STANDIN_CPU_SECONDS     CPU time burnt on top of the sleep (default 0)
+    STANDIN_OUTPUT_MB       size of the output raster (default 1)
+    STANDIN_FAIL_RATE       fraction of runs that fail, 0 to 1 (default 0)
+    STANDIN_TRAIN_FRACTION  share of the run skipped when a classifier is given (default 0.5)
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+
+# Folder name prefix per ML_MODEL index, like the folders SCP creates
+ALGORITHM_FOLDERS = {
+    0: 'MinimumDistance', 1: 'MaximumLikelihood', 2: 'SpectralAngleMapping',
+    3: 'RandomForest', 4: 'SupportVectorMachine', 5: 'MultiLayerPerceptron',
+    6: 'PytorchMultiLayerPerceptron',
+}
+PROGRESS_STEPS = 20
+
+
+# --- 1. QGIS STAND-INS ---
+class Signal:
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+
+class Qgis:
+    @staticmethod
+    def version():
+        return "standin"
+
+
+class QgsApplication:
+    def __init__(self, argv, gui_enabled):
+        pass
+
+    def initQgis(self):
+        pass
+
+    def exitQgis(self):
+        pass
+
+
+class QgsProcessingContext:
+    pass
+
+
+class QgsProcessingFeedback:
+    """The parts of QgsProcessingFeedback the server uses."""
+
+    def __init__(self):
+        self.progressChanged = Signal()
+        self._progress = 0.0
+        self._canceled = False
+
+    def setProgress(self, progress):
+        self._progress = progress
+        self.progressChanged.emit(progress)
+
+    def progress(self):
+        return self._progress
+
+    def isCanceled(self):
+        return self._canceled
+
+    def cancel(self):
+        self._canceled = True
+
+    def setProgressText(self, text):
+        pass
+
+    def pushInfo(self, info):
+        pass
+
+    def pushWarning(self, warning):
+        pass
+
+    def reportError(self, error, fatalError=False):
+        pass
+
+    def pushCommandInfo(self, info):
+        pass
+
+    def pushConsoleInfo(self, info):
+        pass
+
+
+# --- 2. STAND-IN ALGORITHM ---
+def setting(params, name, default):
+    """A stand-in setting from the request parameters, else the environment."""
+    return float(params.get(name, os.environ.get(name, default)))
+
+
+def burn_cpu(seconds):
+    """Keeps one core busy for about this many seconds."""
+    deadline = time.process_time() + seconds
+    digest = b''
+    while time.process_time() < deadline:
+        digest = hashlib.sha256(digest).digest()
+
+
+class Classification:
+    """Behaves like the SCP classification algorithm from the server's point of view."""
+
+    def name(self):
+        return 'standin_classification'
+
+    def initAlgorithm(self, config=None):
+        pass
+
+    def run(self, params, context, feedback):
+        sleep_seconds = setting(params, 'STANDIN_SLEEP_SECONDS', 5)
+        cpu_seconds = setting(params, 'STANDIN_CPU_SECONDS', 0)
+        if params.get('CLASSIFIER_INPUT_RSMO'):
+            # No training to do
+            keep = 1 - setting(params, 'STANDIN_TRAIN_FRACTION', 0.5)
+            sleep_seconds, cpu_seconds = sleep_seconds * keep, cpu_seconds * keep
+
+        feedback.setProgressText("Running stand-in classification")
+        for step in range(PROGRESS_STEPS):
+            if feedback.isCanceled():
+                return {}, False
+            time.sleep(sleep_seconds / PROGRESS_STEPS)
+            burn_cpu(cpu_seconds / PROGRESS_STEPS)
+            feedback.setProgress(100.0 * (step + 1) / PROGRESS_STEPS)
+
+        if random.random() < setting(params, 'STANDIN_FAIL_RATE', 0):
+            feedback.reportError("Stand-in failure", True)
+            return {}, False
+
+        algorithm = ALGORITHM_FOLDERS.get(params.get('ML_MODEL'), 'Classification')
+        folder = Path(params['CLASSIFICATION_FOLDER']) / (
+            f"{algorithm}-{datetime.now():%Y%m%d_%H%M%S}-{os.urandom(3).hex()}"
+        )
+        folder.mkdir(parents=True)
+        raster_output = folder / 'classification.tif'
+        with open(raster_output, 'wb') as f:
+            for _ in range(int(setting(params, 'STANDIN_OUTPUT_MB', 1))):
+                f.write(os.urandom(1024 * 1024))
+
+        if params.get('SAVE_SIGNATURE'):
+            (folder / 'classifier.rsmo').write_bytes(os.urandom(1024))
+        if params.get('TESTING_INPUT_SCPX'):
+            (folder / 'accuracy_report.csv').write_text(
+                f"Overall accuracy [%] = {random.uniform(70, 95):.2f}\n"
+            )
+        feedback.pushInfo(f"Wrote {raster_output}")
+        return {'RASTER_OUTPUT': str(raster_output)}, True
+
+
+# --- 3. LOCAL S3 STAND-IN ---
+class LocalS3Client:
+    """
+    The two S3 client calls the server makes, backed by a local folder laid out
+    as <root>/<bucket>/<key>. Uploads can be throttled to mimic a real link.
+    """
+
+    def __init__(self, root, megabytes_per_second=0):
+        self.root = Path(root)
+        self.megabytes_per_second = megabytes_per_second
+
+    def object_path(self, bucket, key):
+        return self.root / bucket / key
+
+    def head_object(self, Bucket, Key):
+        path = self.object_path(Bucket, Key)
+        if not path.is_file():
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        meta_path = path.with_name(path.name + '.metadata.json')
+        metadata = json.loads(meta_path.read_text()) if meta_path.is_file() else {}
+        return {'ContentLength': path.stat().st_size, 'Metadata': metadata}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        path = self.object_path(Bucket, Key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if self.megabytes_per_second:
+            time.sleep(os.path.getsize(Filename) / (self.megabytes_per_second * 1024 * 1024))
+        temp_path = path.with_name(path.name + f'.{os.getpid()}.tmp')
+        shutil.copyfile(Filename, temp_path)
+        os.replace(temp_path, path)
+        metadata = (ExtraArgs or {}).get('Metadata', {})
+        path.with_name(path.name + '.metadata.json').write_text(json.dumps(metadata))